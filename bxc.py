@@ -16,6 +16,7 @@ from bxlib.bxparser     import Parser
 from bxlib.bxmm         import MM
 from bxlib.bxtychecker  import check as tycheck
 from bxlib.bxasmgen     import AsmGen
+from bxlib.bxopt        import optimize
 from bxlib.bxtac        import *
 
 # ====================================================================
@@ -28,6 +29,14 @@ def parse_args():
         '--arch', choices = sorted(AsmGen.BACKENDS.keys()),
         help = 'Target architecture')
 
+    parser.add_argument(
+        '-O', dest = 'optlevel', type = int, choices = [0, 1], default = 0,
+        help = 'Optimisation level')
+
+    parser.add_argument(
+        '--report', action = 'store_true', default = False,
+        help = 'Report optimisation decisions on stderr')
+
     parser.add_argument('input', help = 'input file (.bx)')
 
     aout = parser.parse_args()
@@ -71,10 +80,19 @@ def _main():
     if not tycheck(prgm, reporter = reporter):
         exit(1)
 
-    tac = MM.mm(prgm)
+    tac = MM.mm(prgm, reporter = reporter)
+
+    if tac is None:
+        exit(1)
+
+    report = None
+    if args.report:
+        report = lambda x: print(x, file = sys.stderr)
+
+    tac = optimize(tac, level = args.optlevel, report = report)
 
     abk = AsmGen.get_backend(args.arch)
-    asm = abk.lower(tac)
+    asm = abk.lower(tac, optlevel = args.optlevel, report = report)
 
     basename = os.path.splitext(args.input)[0]
 
@@ -1,7 +1,11 @@
 # --------------------------------------------------------------------
 import abc
 
-from .bxtac import *
+from .bxframe    import FrameLayout, SharedRegisters
+from .bxisel     import Node, Trees
+from .bxnesting  import Nesting
+from .bxpeephole import Instr, Label, Peephole
+from .bxtac      import *
 
 # --------------------------------------------------------------------
 class AsmGen(abc.ABC):
@@ -15,8 +19,24 @@ class AsmGen(abc.ABC):
         self._temps     = dict()
         self._nextindex = 0
         self._asm       = []
+        self._name      = None
+        self._nesting   = None
+        self._regs      = dict()
+        self._shared    = dict()
+        self._frame     = None
+        self._instr     = None
 
     def _temp(self, temp, size = 1):
+        prelude, temp = self._operand(temp, size)
+        for i in prelude:
+            self._emit(*i)
+        return temp
+
+    def _operand(self, temp, size = 1):
+        # (instructions to emit first, operand)
+        if isinstance(temp, int):
+            return [], self._format_imm(temp)
+
         parts = temp.split(':')
         if len(parts) == 2:
             temp, link_depth = parts[0], self.curr_depth - int(parts[1])
@@ -25,8 +45,19 @@ class AsmGen(abc.ABC):
 
         if temp.startswith('@'):
             prelude, temp = self._format_temp(temp[1:], None)
+        elif link_depth > 0:
+            # captured temporaries live at a fixed slot of their owner
+            # frame, or in the register they share with it
+            owner = self._nesting.ancestor(self._name, link_depth)
+            if (owner, temp) in self._shared:
+                prelude, temp = [], self._shared[owner, temp]
+            else:
+                index = self._nesting.frame(owner)[temp]
+                prelude, temp = self._format_temp(index, link_depth)
         elif temp in self._tparams:
-            prelude, temp = [], self._format_param_with_static_link(self._tparams[temp])
+            prelude, temp = [], self._format_param(self._tparams[temp])
+        elif temp in self._regs:
+            prelude, temp = [], self._regs[temp]
         else:
             if temp in self._temps:
                 index = self._temps[temp]
@@ -35,9 +66,17 @@ class AsmGen(abc.ABC):
                 self._temps[temp] = index
                 self._nextindex += size
             prelude, temp = self._format_temp(index, link_depth)
-        for i in prelude:
-            self._emit(*i)
-        return temp
+        return prelude, temp
+
+    def _loc(self, temp):
+        # register allocated to a temporary of the current frame, if any
+        if isinstance(temp, int) or temp.startswith('@'):
+            return None
+        parts = temp.split(':')
+        if len(parts) == 2 and self.curr_depth != int(parts[1]):
+            owner = self._nesting.ancestor(self._name, self.curr_depth - int(parts[1]))
+            return self._shared.get((owner, parts[0]))
+        return self._regs.get(parts[0])
 
     @abc.abstractmethod
     def _format_temp(self, index, link_depth=None):
@@ -47,19 +86,20 @@ class AsmGen(abc.ABC):
     def _format_param(self, index):
         pass
 
-    @abc.abstractmethod
-    def _format_param_with_static_link(self, index):
-        pass
+    def _format_imm(self, value):
+        return f'${value}'
 
     def __call__(self, instr: TAC | str):
         if isinstance(instr, str):
-            self._asm.append(instr)
+            self._emit_label(instr[:-1])
             return
 
         opcode = instr.opcode
         args   = instr.arguments[:]
 
-        if opcode in ['call', 'fatptr']:
+        self._instr = instr
+
+        if opcode in ['call', 'fatptr', 'tailcall']:
             args.append(instr.link_depth)
         else:
             assert(instr.link_depth is None)
@@ -104,14 +144,42 @@ class AsmGen_x64_Linux(AsmGen):
     SYSTEM  = 'Linux'
     MACHINE = 'x86_64'
     PARAMS  = ['%rdi', '%rsi', '%rdx', '%rcx', '%r8', '%r9']
+    LINK    = '%r10'
     depths  = dict()
 
+    # BX procedures call each other with the C convention, except that
+    # the static link of a nested callee is passed in %r10 (as GCC does
+    # for nested functions): the callee stores it in the first slot of
+    # its frame when it, or one of its nested procedures, walks the
+    # static chain. Only the parameters 7+ are pushed.
+
+    # allocatable registers: %rax, %rcx, %rdx, %r11, %r12 and %r13 are
+    # used as scratch registers by the instruction emitters -- %rdx only
+    # by divisions, and is allocatable in the procedures that have none
+    CALLER_SAVED = ['%r10', '%rsi', '%rdi', '%r8', '%r9']
+    CALLEE_SAVED = ['%rbx', '%r14', '%r15']
+
+    # at -O1, the leaf procedures (no calls but tail calls, no fat
+    # pointers, no nested procedures) whose frame fits in the red zone
+    # below %rsp are emitted without frame: their slots are addressed
+    # from %rsp, that does not move
+    REDZONE = 128
+
     def __init__(self):
         super().__init__()
         self._params = []
         self._endlbl = None
+        self._display = dict()
+        self._linked  = False
+        self._fp      = '%rbp'          # frame base register
         self.curr_depth = 0
 
+    def _get_asm(self, opcode, *args):
+        return Instr(opcode, list(args))
+
+    def _get_label(self, lbl):
+        return Label(lbl)
+
     def _format_temp(self, index, link_depth):
         if isinstance(index, str):
             return [], f'{index}(%rip)'
@@ -119,25 +187,59 @@ class AsmGen_x64_Linux(AsmGen):
         assert(link_depth is not None)
 
         if link_depth == 0:
-            return [], f'-{8*(index+1)}(%rbp)'
+            return [], f'-{8*(index+1)}({self._fp})'
+
+        return self._chain(link_depth), f'-{8*(index+1)}(%r12)'
+
+    def _chain(self, link_depth):
+        # loads in %r12 the frame pointer `link_depth` static links away
+        if link_depth in self._display:
+            return [['movq', self._format_temp(self._display[link_depth], 0)[1], '%r12']]
 
-        prelude = [['movq', '%rbp', '%r12']]
+        self._linked = True
 
-        for i in range(link_depth):
-            prelude.append(['movq', '24(%r12)', '%r12'])
+        prelude = [['movq', self._link(self._fp), '%r12']]
 
-        return prelude, f'-{8*(index+1)}(%r12)'
+        for i in range(link_depth - 1):
+            prelude.append(['movq', self._link('%r12'), '%r12'])
+
+        return prelude
+
+    def _link(self, base):
+        # the static link of the nested frame at `base` (first slot, see
+        # `Nesting.frame`)
+        return f'-8({base})'
+
+    def _emit_display(self, display):
+        # fills the display, walking the static chain once
+        base, walked = self._fp, 0
+        for hops in sorted(display):
+            self._linked = True
+            for i in range(hops - walked):
+                self._emit('movq', self._link(base), '%r12')
+                base = '%r12'
+            walked = hops
+            self._emit('movq', '%r12', self._format_temp(display[hops], 0)[1])
+        self._display = display
 
     def _format_param(self, index):
+        if self._fp == '%rsp':
+            return f'{8*(index+1)}(%rsp)'
         return f'{8*(index+2)}(%rbp)'
 
-    def _format_param_with_static_link(self, index):
-        return f'{8*(index+4)}(%rbp)'
-
     def _emit_const(self, ctt, dst):
-        self._emit('movq', f'${ctt}', self._temp(dst))
+        if fits32(ctt):
+            self._emit('movq', f'${ctt}', self._temp(dst))
+        elif self._loc(dst) is not None:
+            self._emit('movabsq', f'${ctt}', self._temp(dst))
+        else:
+            self._emit('movabsq', f'${ctt}', '%r11')
+            self._emit('movq', '%r11', self._temp(dst))
 
     def _emit_copy(self, src, dst):
+        if self._loc(src) is not None or self._loc(dst) is not None:
+            self._emit('movq', self._temp(src), self._temp(dst))
+            return
         self._emit('movq', self._temp(src), '%r11')
         self._emit('movq', '%r11', self._temp(dst))
 
@@ -165,20 +267,24 @@ class AsmGen_x64_Linux(AsmGen):
 
     def _emit_mul(self, op1, op2, dst):
         self._emit('movq', self._temp(op1), '%rax')
-        self._emit('imulq', self._temp(op2))
+        self._emit('imulq', self._temp(op2), '%rax')
         self._emit('movq', '%rax', self._temp(dst))
 
-    def _emit_div(self, op1, op2, dst):
+    def _emit_divmod(self, op1, op2, result, dst):
         self._emit('movq', self._temp(op1), '%rax')
         self._emit('cqto')
-        self._emit('idivq', self._temp(op2))
-        self._emit('movq', '%rax', self._temp(dst))
+        if isinstance(op2, int):
+            self._emit('movq', self._temp(op2), '%rcx')
+            self._emit('idivq', '%rcx')
+        else:
+            self._emit('idivq', self._temp(op2))
+        self._emit('movq', result, self._temp(dst))
+
+    def _emit_div(self, op1, op2, dst):
+        self._emit_divmod(op1, op2, '%rax', dst)
 
     def _emit_mod(self, op1, op2, dst):
-        self._emit('movq', self._temp(op1), '%rax')
-        self._emit('cqto')
-        self._emit('idivq', self._temp(op2))
-        self._emit('movq', '%rdx', self._temp(dst))
+        self._emit_divmod(op1, op2, '%rdx', dst)
 
     def _emit_and(self, op1, op2, dst):
         self._emit_alu2('andq', op1, op2, dst)
@@ -189,17 +295,47 @@ class AsmGen_x64_Linux(AsmGen):
     def _emit_xor(self, op1, op2, dst):
         self._emit_alu2('xorq', op1, op2, dst)
 
-    def _emit_shl(self, op1, op2, dst):
+    def _emit_setcmp(self, cd, op1, op2, dst):
+        self._emit_cmp(op1, op2)
+        self._emit(cd, '%al')
+        if self._loc(dst) is not None:
+            self._emit('movzbq', '%al', self._temp(dst))
+        else:
+            self._emit('movzbq', '%al', '%rax')
+            self._emit('movq', '%rax', self._temp(dst))
+
+    def _emit_seteq(self, op1, op2, dst):
+        self._emit_setcmp('sete', op1, op2, dst)
+
+    def _emit_setne(self, op1, op2, dst):
+        self._emit_setcmp('setne', op1, op2, dst)
+
+    def _emit_setlt(self, op1, op2, dst):
+        self._emit_setcmp('setl', op1, op2, dst)
+
+    def _emit_setle(self, op1, op2, dst):
+        self._emit_setcmp('setle', op1, op2, dst)
+
+    def _emit_setgt(self, op1, op2, dst):
+        self._emit_setcmp('setg', op1, op2, dst)
+
+    def _emit_setge(self, op1, op2, dst):
+        self._emit_setcmp('setge', op1, op2, dst)
+
+    def _emit_shift(self, opcode, op1, op2, dst):
         self._emit('movq', self._temp(op1), '%r11')
-        self._emit('movq', self._temp(op2), '%rcx')
-        self._emit('salq', '%cl', '%r11')
+        if isinstance(op2, int):
+            self._emit(opcode, f'${op2 & 63}', '%r11')
+        else:
+            self._emit('movq', self._temp(op2), '%rcx')
+            self._emit(opcode, '%cl', '%r11')
         self._emit('movq', '%r11', self._temp(dst))
 
+    def _emit_shl(self, op1, op2, dst):
+        self._emit_shift('salq', op1, op2, dst)
+
     def _emit_shr(self, op1, op2, dst):
-        self._emit('movq', self._temp(op1), '%r11')
-        self._emit('movq', self._temp(op2), '%rcx')
-        self._emit('sarq', '%cl', '%r11')
-        self._emit('movq', '%r11', self._temp(dst))
+        self._emit_shift('sarq', op1, op2, dst)
 
     def _emit_jmp(self, lbl):
         self._emit('jmp', lbl)
@@ -214,59 +350,138 @@ class AsmGen_x64_Linux(AsmGen):
     def _emit_jnz(self, op, lbl):
         self._emit_cjmp('jnz', op, lbl)
 
-    def _emit_jlt(self, op, lbl):
-        self._emit_cjmp('jl', op, lbl)
+    def _cmp(self, op1, op2):
+        # flags of `op1 - op2`; the first operand of `cmpq` can be an
+        # immediate, the second one cannot
+        prelude1, x1 = self._operand(op1)
+        prelude2, x2 = self._operand(op2)
+        if self._loc(op1) is not None or (
+            not isinstance(op1, int)
+            and (self._loc(op2) is not None or isinstance(op2, int))
+        ):
+            return prelude1 + prelude2 + [('cmpq', x2, x1)]
+        return prelude1 + [('movq', x1, '%r11')] + prelude2 + [('cmpq', x2, '%r11')]
+
+    def _emit_cmp(self, op1, op2):
+        for i in self._cmp(op1, op2):
+            self._emit(*i)
+
+    def _emit_jcmp(self, cd, op1, op2, lbl):
+        # jumps when `op1 <cd> op2`
+        self._emit_cmp(op1, op2)
+        self._emit(cd, lbl)
+
+    def _emit_jeq(self, op1, op2, lbl):
+        self._emit_jcmp('je', op1, op2, lbl)
+
+    def _emit_jne(self, op1, op2, lbl):
+        self._emit_jcmp('jne', op1, op2, lbl)
 
-    def _emit_jle(self, op, lbl):
-        self._emit_cjmp('jle', op, lbl)
+    def _emit_jlt(self, op1, op2, lbl):
+        self._emit_jcmp('jl', op1, op2, lbl)
 
-    def _emit_jgt(self, op, lbl):
-        self._emit_cjmp('jg', op, lbl)
+    def _emit_jle(self, op1, op2, lbl):
+        self._emit_jcmp('jle', op1, op2, lbl)
 
-    def _emit_jge(self, op, lbl):
-        self._emit_cjmp('jge', op, lbl)
+    def _emit_jgt(self, op1, op2, lbl):
+        self._emit_jcmp('jg', op1, op2, lbl)
+
+    def _emit_jge(self, op1, op2, lbl):
+        self._emit_jcmp('jge', op1, op2, lbl)
 
     def _emit_param(self, i, arg):
         assert(len(self._params)+1 == i)
         self._params.append(arg)
 
-    def _emit_call(self, lbl, arg, link_depth, ret = None):
-        assert(arg == len(self._params))
-
-        for i, x in enumerate(self._params[:6]):
-            self._emit('movq', self._temp(x), self.PARAMS[i])
-
-        qarg = 0 if arg <= 6 else arg - 6
+    def _emit_moves(self, moves):
+        # parallel moves between registers ('reg', r) and temporaries
+        # ('temp', t): a source is read before being overwritten, and
+        # cycles are broken through %r11
+        def norm(x):
+            if x[0] == 'temp' and self._loc(x[1]) is not None:
+                return ('reg', self._loc(x[1]))
+            return x
+
+        def operand(x):
+            return x[1] if x[0] == 'reg' else self._temp(x[1])
+
+        pending = [(norm(x), norm(y)) for x, y in moves]
+        pending = [(x, y) for x, y in pending if x != y]
+
+        while pending:
+            for i, (src, dst) in enumerate(pending):
+                if all(x != dst for x, _ in pending):
+                    del pending[i]
+                    if src[0] == 'reg' or dst[0] == 'reg':
+                        self._emit('movq', operand(src), operand(dst))
+                    else:
+                        self._emit('movq', operand(src), '%rax')
+                        self._emit('movq', '%rax', operand(dst))
+                    break
+            else:
+                _, dst = pending[0]
+                self._emit('movq', dst[1], '%r11')
+                pending = [(('reg', '%r11') if x == dst else x, y) for x, y in pending]
+
+    def _spill_slot(self, reg):
+        return self._format_temp(self._frame.spills[reg], 0)[1]
+
+    def _emit_saves(self):
+        # caller-saved registers that are live across the current call
+        if self._frame is None:
+            return []
+        saves = self._frame.saves.get(id(self._instr), [])
+        for reg in saves:
+            self._emit('movq', reg, self._spill_slot(reg))
+        return saves
+
+    def _emit_restores(self, saves):
+        for reg in saves:
+            self._emit('movq', self._spill_slot(reg), reg)
+
+    def _emit_leave(self):
+        # restore the callee-saved registers and pop the frame
+        if self._frame is not None:
+            for reg in self.CALLEE_SAVED:
+                if reg in self._frame.spills:
+                    self._emit('movq', self._spill_slot(reg), reg)
+        if self._fp == '%rbp':
+            self._emit('movq', '%rbp', '%rsp')
+            self._emit('popq', '%rbp')
+
+    def _emit_args(self, params):
+        # stack arguments first: the register moves may overwrite the
+        # registers that hold them
+        qarg = max(0, len(params) - 6)
 
         if qarg & 0x1:
             self._emit('subq', '$8', '%rsp')
 
-        for x in self._params[6:][::-1]:
+        for x in params[6:][::-1]:
             self._emit('pushq', self._temp(x))
 
-        if link_depth is not None:
+        self._emit_moves([
+            (('temp', x), ('reg', self.PARAMS[i]))
+            for i, x in enumerate(params[:6])
+        ])
 
-            if link_depth == 0:
-                self._emit('pushq', '%rbp')
-            else:
-                self._emit('movq', '%rbp', '%r12')
-
-                for i in range(link_depth):
-                    self._emit('movq', '24(%r12)', '%r12')
+        return qarg
 
-                self._emit('pushq', '%r12')
+    def _emit_call(self, lbl, arg, link_depth, ret = None):
+        assert(arg == len(self._params))
 
-        else:
-            self._emit('pushq', '$0')
+        saves = self._emit_saves()
+        qarg  = self._emit_args(self._params)
 
-        self._emit('pushq', '$0')
+        # the static link is set last: %r10 may hold a parameter
+        self._emit_static_link(link_depth)
 
         self._emit('callq', lbl)
 
         if qarg > 0:
             self._emit('addq', f'${8*(qarg + (qarg & 0x1))}', '%rsp')
 
-        self._emit('addq', '$16', '%rsp')
+        self._emit_restores(saves)
 
         if ret is not None:
             self._emit('movq', '%rax', self._temp(ret))
@@ -274,62 +489,340 @@ class AsmGen_x64_Linux(AsmGen):
         self._params = []
 
     def _emit_callfatptr(self, fatptr_temp, arg, ret = None):
-        # extract function address from fatptr
-        self._emit('movq', self._temp(fatptr_temp), '%r12')
-
         assert(arg == len(self._params))
 
-        for i, x in enumerate(self._params[:6]):
-            self._emit('movq', self._temp(x), self.PARAMS[i])
+        saves = self._emit_saves()
 
-        qarg = 0 if arg <= 6 else arg - 6
+        # the fat pointer is loaded before the parameters, that may
+        # overwrite its register (%r12 is used to walk static chains)
+        self._emit('movq', self._temp(fatptr_temp), '%r13')
 
-        if qarg & 0x1:
-            self._emit('subq', '$8', '%rsp')
+        qarg = self._emit_args(self._params)
 
-        for x in self._params[6:][::-1]:
-            self._emit('pushq', self._temp(x))
-
-        self._emit('pushq', '-8(%r12)') # static link put on stack
-        self._emit('pushq', '$0')
+        self._emit('movq', '-8(%r13)', self.LINK)
 
-        self._emit('callq', '*(%r12)')
+        self._emit('callq', '*(%r13)')
 
         if qarg > 0:
             self._emit('addq', f'${8 * (qarg + (qarg & 0x1))}', '%rsp')
 
-        self._emit('addq', '$16', '%rsp')
+        self._emit_restores(saves)
 
         if ret is not None:
             self._emit('movq', '%rax', self._temp(ret))
 
         self._params = []
 
+    def _emit_static_link(self, link_depth):
+        # passes the static link of a nested callee in %r10
+        if link_depth == 0:
+            self._emit('movq', '%rbp', self.LINK)
+        elif link_depth is not None:
+            for i in self._chain(link_depth):
+                self._emit(*i)
+            self._emit('movq', '%r12', self.LINK)
+
+    def _emit_tailcall(self, lbl, arg, link_depth):
+        # the callee takes over the frame of our caller: jump instead
+        # of calling once the frame is popped
+        assert(arg == len(self._params) and arg <= 6)
+        assert(link_depth != 0)
+
+        self._emit_args(self._params)
+        self._emit_static_link(link_depth)
+
+        self._emit_leave()
+        self._emit('jmp', lbl)
+
+        self._params = []
+
+    def _emit_tailcallfatptr(self, fatptr_temp, arg):
+        assert(arg == len(self._params) and arg <= 6)
+
+        self._emit('movq', self._temp(fatptr_temp), '%r13')
+        self._emit_args(self._params)
+
+        self._emit('movq', '-8(%r13)', self.LINK)
+        self._emit('movq', '(%r13)', '%r11')
+
+        self._emit_leave()
+        self._emit('jmp', '*%r11')
+
+        self._params = []
+
     def _emit_fatptr(self, f_label, link_depth, dst):
         # create the fat pointer at dst
         self._emit('leaq', self._temp(dst, size = 3), '%r13')
 
-        self._emit('movq', '%r13', '(%r13)')
-        self._emit('subq', '$8', '(%r13)')
+        self._emit('leaq', '-8(%r13)', '%rax')
+        self._emit('movq', '%rax', '(%r13)')
 
         # self._emit('movq', f"${f_label}", '-8(%r13)')
         self._emit('leaq', f"{f_label}(%rip)", '%rax')
         self._emit('movq', '%rax', '-8(%r13)')
         
-        self._emit('movq', '%rbp', '%r12')
-
-        for i in range(link_depth):
-            self._emit('movq', '24(%r12)', '%r12')
-
-        self._emit('movq', '%r12', '-16(%r13)')
+        if link_depth == 0:
+            self._emit('movq', '%rbp', '-16(%r13)')
+        else:
+            for i in self._chain(link_depth):
+                self._emit(*i)
+            self._emit('movq', '%r12', '-16(%r13)')
 
     def _emit_ret(self, ret = None):
         if ret is not None:
             self._emit('movq', self._temp(ret), '%rax')
         self._emit('jmp', self._endlbl)
 
+    # ----------------------------------------------------------------
+    # Instruction selection over expression trees (-O1)
+    #
+    # Each tree (see bxisel) is covered by tiles. The candidate
+    # instruction sequences for a node are built bottom-up, the value
+    # being computed in a single register, and the cheapest sequence is
+    # kept: 4 units per instruction and per memory access, plus the
+    # size of the immediates.
+
+    ALU = {
+        'add': 'addq', 'sub': 'subq', 'and': 'andq', 'or' : 'orq' ,
+        'xor': 'xorq', 'mul': 'imulq', 'shl': 'salq', 'shr': 'sarq',
+        'neg': 'negq', 'not': 'notq',
+    }
+
+    CC = {
+        'jz' : 'e', 'jnz': 'ne', 'jeq': 'e', 'jne': 'ne',
+        'jlt': 'l', 'jle': 'le', 'jgt': 'g', 'jge': 'ge',
+        'seteq': 'e', 'setne': 'ne', 'setlt': 'l',
+        'setle': 'le', 'setgt': 'g', 'setge': 'ge',
+    }
+
+    SWAPPED_CC = { 'e': 'e', 'ne': 'ne', 'l': 'g', 'le': 'ge', 'g': 'l', 'ge': 'le' }
+
+    @staticmethod
+    def _cost(plan) -> int:
+        cost = 0
+        for opcode, *args in plan:
+            cost += 4
+            for x in args:
+                if '(' in x and opcode != 'leaq':
+                    cost += 4
+                elif x.startswith('$'):
+                    cost += 1 if -128 <= int(x[1:]) < 128 else 4
+        return cost
+
+    def _inreg(self, node: Node, scratch: str):
+        # (instructions, register) for a leaf
+        if node.opcode == 'temp' and self._loc(node.value) is not None:
+            return [], self._loc(node.value)
+        prelude, x = self._operand(node.value)
+        return prelude + [('movq', x, scratch)], scratch
+
+    def _scaled(self, node: Node):
+        # (index, scale) when the node is a leaf times 2, 4 or 8
+        match node:
+            case Node('shl', [x, Node('imm', value = k)]) if x.leaf and 1 <= k <= 3:
+                return x, 1 << k
+            case Node('mul', [x, Node('imm', value = k)]) if x.leaf and k in (2, 4, 8):
+                return x, k
+            case Node('mul', [Node('imm', value = k), x]) if x.leaf and k in (2, 4, 8):
+                return x, k
+        return None
+
+    def _tiles(self, node: Node, reg: str) -> list:
+        # candidate sequences computing `node` in `reg`
+        if node.leaf:
+            prelude, x = self._operand(node.value)
+            return [[] if x == reg else prelude + [('movq', x, reg)]]
+
+        op, aout = node.opcode, []
+        x, y = node.kids[0], (node.kids[1] if len(node.kids) > 1 else None)
+
+        if op in ('neg', 'not'):
+            aout.append(self._tile(x, reg) + [(self.ALU[op], reg)])
+
+        elif op in ('shl', 'shr'):
+            aout.append(self._tile(x, reg) + [(self.ALU[op], f'${y.value & 63}', reg)])
+
+        else:
+            pairs = [(x, y), (y, x)] if op in ('add', 'and', 'or', 'xor', 'mul') else [(x, y)]
+            for a, b in pairs:
+                if not b.leaf:
+                    continue
+                prelude, bx = self._operand(b.value)
+                if op == 'mul' and b.opcode == 'imm' and a.opcode == 'temp':
+                    aprelude, ax = self._operand(a.value)
+                    aout.append(aprelude + [('imulq', bx, ax, reg)])
+                aout.append(self._tile(a, reg) + prelude + [(self.ALU[op], bx, reg)])
+                if b.opcode == 'imm' and (op, b.value) in (('add', 1), ('sub', -1)):
+                    aout.append(self._tile(a, reg) + [('incq', reg)])
+                if b.opcode == 'imm' and (op, b.value) in (('add', -1), ('sub', 1)):
+                    aout.append(self._tile(a, reg) + [('decq', reg)])
+
+            if op == 'sub' and x.leaf and not y.leaf:
+                prelude, xx = self._operand(x.value)
+                aout.append(self._tile(y, reg) + [('negq', reg)] + prelude + [('addq', xx, reg)])
+
+        # address computations
+        if op == 'add':
+            for a, b in [(x, y), (y, x)]:
+                if b.opcode == 'imm' and a.leaf:
+                    plan, r = self._inreg(a, '%rax')
+                    aout.append(plan + [('leaq', f'{b.value}({r})', reg)])
+                if self._scaled(b) is not None:
+                    z, k = self._scaled(b)
+                    plan, r = self._inreg(a, '%rax') if a.leaf else (self._tile(a, reg), reg)
+                    zplan, rz = self._inreg(z, '%rcx')
+                    aout.append(plan + zplan + [('leaq', f'({r},{rz},{k})', reg)])
+            if x.opcode == 'temp' and y.opcode == 'temp':
+                xplan, rx = self._inreg(x, '%rax')
+                yplan, ry = self._inreg(y, '%rcx')
+                aout.append(xplan + yplan + [('leaq', f'({rx},{ry})', reg)])
+
+        if op == 'mul':
+            for a, b in [(x, y), (y, x)]:
+                if b.opcode == 'imm' and a.leaf and b.value in (3, 5, 9):
+                    plan, r = self._inreg(a, '%rax')
+                    aout.append(plan + [('leaq', f'({r},{r},{b.value-1})', reg)])
+
+        if op == 'shl' and x.leaf and 1 <= y.value <= 3:
+            plan, r = self._inreg(x, '%rax')
+            aout.append(plan + [('leaq', f'(,{r},{1 << y.value})', reg)])
+
+        return aout
+
+    def _tile(self, node: Node, reg: str) -> list:
+        return min(self._tiles(node, reg), key = self._cost)
+
+    def _tiles_cmp(self, x: Node, y: Node) -> list:
+        # candidate (sequence, swapped) setting the flags of `x - y`
+        aout = []
+
+        if x.leaf and y.leaf:
+            aout.append((self._cmp(x.value, y.value), False))
+            if y.opcode == 'imm' and y.value == 0 and x.opcode == 'temp' \
+                    and self._loc(x.value) is not None:
+                r = self._loc(x.value)
+                aout.append(([('testq', r, r)], False))
+
+        elif y.leaf:
+            prelude, yx = self._operand(y.value)
+            for plan in self._tiles(x, '%r11'):
+                aout.append((plan + prelude + [('cmpq', yx, '%r11')], False))
+                if y.opcode == 'imm' and y.value == 0:
+                    aout.append((plan + [('testq', '%r11', '%r11')], False))
+                    aout.append((plan, None))       # flags of the last instruction
+            if y.opcode == 'imm' and y.value == 0 and x.opcode == 'and':
+                for a, b in [x.kids, x.kids[::-1]]:
+                    if b.leaf:
+                        prelude, bx = self._operand(b.value)
+                        aout.append((self._tile(a, '%r11') + prelude + [('testq', bx, '%r11')], False))
+
+        else:
+            prelude, xx = self._operand(x.value)
+            plan = self._tile(y, '%r11')
+            if x.opcode == 'imm':
+                aout.append((plan + [('cmpq', xx, '%r11')], True))
+            else:
+                aout.append((plan + prelude + [('cmpq', '%r11', xx)], False))
+
+        return aout
+
+    def _emit_tree(self, instr: TAC, node: Node):
+        self._instr = instr
+        cands = []
+
+        if instr.opcode in self.CC:
+            cc   = self.CC[instr.opcode]
+            jump = not instr.opcode.startswith('set')
+            if instr.opcode in ('jz', 'jnz'):
+                x, y = node.kids[0], Node('imm', value = 0)
+            else:
+                x, y = node.kids
+
+            for plan, swapped in self._tiles_cmp(x, y):
+                if swapped is None:
+                    # reuse the flags of the last arithmetic instruction:
+                    # OF is only cleared by the logical ones
+                    last = plan[-1][0] if plan else None
+                    if last in ('andq', 'orq', 'xorq'):
+                        pass
+                    elif last in ('addq', 'subq', 'negq', 'incq', 'decq') and cc in ('e', 'ne'):
+                        pass
+                    else:
+                        continue
+                cands.append(plan + [(
+                    ('j' if jump else 'set') + (self.SWAPPED_CC[cc] if swapped else cc),
+                    instr.arguments[-1] if jump else '%al',
+                )])
+
+            plan = min(cands, key = self._cost)
+            for i in plan:
+                self._emit(*i)
+            if not jump:
+                if self._loc(instr.result) is not None:
+                    self._emit('movzbq', '%al', self._temp(instr.result))
+                else:
+                    self._emit('movzbq', '%al', '%rax')
+                    self._emit('movq', '%rax', self._temp(instr.result))
+            return
+
+        dst = instr.result
+        dprelude, dx = self._operand(dst)
+        reg = self._loc(dst)
+        if reg is None or any(self._loc(x.value) == reg for x in node.leaves() if x.opcode == 'temp'):
+            reg = '%r11'
+
+        for plan in self._tiles(node, reg):
+            if reg != dx:
+                plan = plan + dprelude + [('movq', reg, dx)]
+            cands.append(plan)
+
+        if node.leaf and node.value == dst:
+            cands.append([])
+
+        # read-modify-write of the destination
+        if not node.leaf and node.opcode in self.ALU:
+            op = node.opcode
+            pairs = [node.kids, node.kids[::-1]] if op in ('add', 'and', 'or', 'xor', 'mul') else [node.kids]
+            for a, *b in pairs:
+                if a.opcode != 'temp' or a.value != dst or not all(x.leaf for x in b):
+                    continue
+                if not b:
+                    cands.append(dprelude + [(self.ALU[op], dx)])
+                    continue
+                b = b[0]
+                prelude, bx = self._operand(b.value)
+                if self._loc(dst) is None and self._loc(b.value) is None and b.opcode != 'imm':
+                    continue
+                if op == 'mul' and self._loc(dst) is None:
+                    continue
+                if op in ('shl', 'shr'):
+                    bx = f'${b.value & 63}'
+                cands.append(prelude + dprelude + [(self.ALU[op], bx, dx)])
+                if b.opcode == 'imm' and (op, b.value) in (('add', 1), ('sub', -1)):
+                    cands.append(dprelude + [('incq', dx)])
+                if b.opcode == 'imm' and (op, b.value) in (('add', -1), ('sub', 1)):
+                    cands.append(dprelude + [('decq', dx)])
+
+        for i in min(cands, key = self._cost):
+            self._emit(*i)
+
+    @staticmethod
+    def _leaf(proc: TACProc, nesting: Nesting) -> bool:
+        return not nesting.children[proc.name] and not any(
+            not isinstance(x, str) and x.opcode in ('call', 'callfatptr', 'fatptr')
+            for x in proc.tac
+        )
+
     @classmethod
-    def lower1(cls, tac: TACProc | TACVar) -> list[str]:
+    def lower1(
+        cls,
+        tac       : TACProc | TACVar,
+        nesting   : Nesting,
+        optlevel  : int = 0,
+        report    = None,
+        shared    : SharedRegisters = None,
+        frameless : bool = True,
+    ) -> list[str]:
         emitter = cls()
 
         match tac:
@@ -344,37 +837,147 @@ class AsmGen_x64_Linux(AsmGen):
             case TACProc(depth, name, arguments, ptac):
                 emitter.curr_depth = depth + 1
                 emitter._endlbl = f'.E_{name}'
-
-                for i in range(min(6, len(arguments))):
-                    emitter._emit('movq', emitter.PARAMS[i], emitter._temp(arguments[i]))
+                emitter._name = name
+                emitter._nesting = nesting
+
+                frame = nesting.frame(name)
+                emitter._temps.update(frame)
+                emitter._nextindex = len(frame)
+
+                trees = None
+
+                if optlevel >= 1:
+                    layout = FrameLayout(tac, nesting)
+                    trees  = Trees(tac, nesting, layout.key).run()
+                    caller = cls.CALLER_SAVED
+                    if not any(
+                        not isinstance(x, str) and x.opcode in ('div', 'mod') for x in ptac
+                    ):
+                        caller = caller + ['%rdx']
+                    pinned = shared.pinned.get(name, [])
+                    callee = [
+                        r for r in cls.CALLEE_SAVED
+                        if r not in pinned and r not in shared.reserved.get(name, [])
+                    ]
+                    emitter._frame = layout.run(
+                        caller = caller, callee = callee,
+                        params = cls.PARAMS, pinned = pinned, trees = trees,
+                    )
+                    emitter._temps.update(emitter._frame.slots)
+                    emitter._shared    = shared.shared
+                    emitter._regs      = dict(emitter._frame.regs)
+                    emitter._nextindex = emitter._frame.size
+
+                    for (owner, temp), reg in shared.shared.items():
+                        if owner == name:
+                            emitter._regs[temp] = reg
+
+                    if frameless and cls._leaf(tac, nesting) \
+                            and 8*emitter._frame.size <= cls.REDZONE:
+                        emitter._fp = '%rsp'
+
+                    for reg in cls.CALLEE_SAVED:
+                        if reg in emitter._frame.spills:
+                            emitter._emit('movq', reg, emitter._spill_slot(reg))
+
+                    emitter._emit_display(emitter._frame.display)
+
+                emitter._emit_moves([
+                    (('reg', emitter.PARAMS[i]), ('temp', arguments[i]))
+                    for i in range(min(6, len(arguments)))
+                ])
 
                 for i, arg in enumerate(arguments[6:]):
-                    emitter._tparams[arg] = i
+                    if arg in frame:
+                        emitter._emit('movq', emitter._format_param(i), '%r11')
+                        emitter._emit('movq', '%r11', emitter._temp(arg))
+                    else:
+                        emitter._tparams[arg] = i
 
                 for instr in ptac:
-                    emitter(instr)
+                    if trees is None or isinstance(instr, str):
+                        emitter(instr)
+                    elif id(instr) in trees.roots:
+                        emitter._emit_tree(instr, trees.roots[id(instr)])
+                    elif id(instr) not in trees.folded:
+                        emitter(instr)
+
+                if emitter._fp == '%rsp' and 8*emitter._nextindex > cls.REDZONE:
+                    return cls.lower1(tac, nesting, optlevel, report, shared, frameless = False)
 
                 nvars  = emitter._nextindex
                 nvars += nvars & 1
 
-                return [
+                if emitter._frame is not None and report is not None:
+                    before  = emitter._frame.before
+                    before += before & 1
+                    report(
+                        f'frame: {name}: {8*before} -> {8*nvars} bytes, '
+                        f'{len(emitter._frame.regs)} temporaries in registers'
+                        + (', frameless' if emitter._fp == '%rsp' else '')
+                    )
+                    report(
+                        f'isel: {name}: {len(trees.roots)} trees, '
+                        f'{len(trees.folded)} temporaries folded'
+                    )
+
+                epilogue = cls()
+                epilogue._frame = emitter._frame
+                epilogue._fp    = emitter._fp
+                epilogue._emit_leave()
+
+                # the static link is only saved when the chain is walked
+                # from this frame or from a nested one
+                link = []
+                if Nesting.LINK in frame and (emitter._linked or nesting.children[name]):
+                    link = [emitter._get_asm('movq', cls.LINK, emitter._link(emitter._fp))]
+
+                prologue = []
+                if emitter._fp == '%rbp':
+                    prologue = [
+                        emitter._get_asm('pushq', '%rbp'),
+                        emitter._get_asm('movq', '%rsp', '%rbp'),
+                        emitter._get_asm('subq', f'${8*nvars}', '%rsp'),
+                    ]
+
+                code = [
                     emitter._get_asm('.text'),
                     emitter._get_asm('.globl', name),
                     emitter._get_label(name),
-                    emitter._get_asm('pushq', '%rbp'),
-                    emitter._get_asm('movq', '%rsp', '%rbp'),
-                    emitter._get_asm('subq', f'${8*nvars}', '%rsp'),
-                ] + emitter._asm + [
+                ] + prologue + link + emitter._asm + [
                     emitter._get_label(emitter._endlbl),
-                    emitter._get_asm('movq', '%rbp', '%rsp'),
-                    emitter._get_asm('popq', '%rbp'),
+                ] + epilogue._asm + [
                     emitter._get_asm('retq'),
                 ]
 
+                if optlevel >= 1:
+                    peephole = Peephole()
+                    size     = len(code)
+                    code     = peephole.run(code)
+                    if report is not None:
+                        rules = ', '.join(f'{k}: {v}' for k, v in sorted(peephole.counts.items()))
+                        report(
+                            f'peephole: {name}: {size} -> {len(code)} instructions'
+                            + (f' ({rules})' if rules else '')
+                        )
+
+                return code
+
     @classmethod
-    def lower(cls, tacs: list[TACProc | TACVar]) -> str:
-        aout = [cls.lower1(tac) for tac in tacs]
-        aout = [x for tac in aout for x in tac]
+    def lower(
+        cls,
+        tacs     : list[TACProc | TACVar],
+        optlevel : int = 0,
+        report   = None,
+    ) -> str:
+        nesting = Nesting(tacs)
+        shared  = SharedRegisters(tacs, nesting, cls.CALLEE_SAVED)
+        if optlevel >= 1:
+            for (owner, temp), reg in sorted(shared.run().items()):
+                if report is not None:
+                    report(f'shared: {temp} of {owner} kept in {reg}')
+        aout = [cls.lower1(tac, nesting, optlevel, report, shared) for tac in tacs]
+        aout = [str(x) for tac in aout for x in tac]
         return "\n".join(aout) + "\n"
 
 AsmGen.register(AsmGen_x64_Linux)
@@ -408,14 +1011,24 @@ class AsmGen_arm64_Darwin(AsmGen):
     def _format_param(self, index):
         return f'[FP, #{8*(index+2)}]'
 
-    def _emit_const(self, ctt, dst):
+    def _emit_mov(self, reg, ctt):
         if ctt < 0:
             ctt = (1 << 64) + ctt
-        self._emit('movz', 'X9', f'#{ctt & 0xffff}')
+        self._emit('movz', reg, f'#{ctt & 0xffff}')
         ctt, i = (ctt >> 16), 1
         while ctt != 0:
-            self._emit('movk', 'X9', f'#{ctt & 0xffff}', f'lsl {16*i}')
+            self._emit('movk', reg, f'#{ctt & 0xffff}', f'lsl {16*i}')
             ctt >>= 16; i += 1
+
+    def _load(self, reg, op):
+        # an operand, temporary or immediate, into a register
+        if isinstance(op, int):
+            self._emit_mov(reg, op)
+        else:
+            self._emit('ldr', reg, self._temp(op))
+
+    def _emit_const(self, ctt, dst):
+        self._emit_mov('X9', ctt)
         self._emit('str', 'X9', self._temp(dst))
 
     def _emit_copy(self, src, dst):
@@ -434,8 +1047,8 @@ class AsmGen_arm64_Darwin(AsmGen):
         self._emit_alu1('mvn', src, dst)
 
     def _emit_alu2(self, opcode, op1, op2, dst):
-        self._emit('ldr', 'X9', self._temp(op1))
-        self._emit('ldr', 'X10', self._temp(op2))
+        self._load('X9', op1)
+        self._load('X10', op2)
         self._emit(opcode, 'X11', 'X9', 'X10')
         self._emit('str', 'X11', self._temp(dst))
 
@@ -452,8 +1065,8 @@ class AsmGen_arm64_Darwin(AsmGen):
         self._emit_alu2('sdiv', op1, op2, dst)
 
     def _emit_mod(self, op1, op2, dst):
-        self._emit('ldr' , 'X9', self._temp(op1))
-        self._emit('ldr' , 'X10', self._temp(op2))
+        self._load('X9', op1)
+        self._load('X10', op2)
         self._emit('sdiv', 'X11', 'X9', 'X10')
         self._emit('mul' , 'X11', 'X11', 'X10')
         self._emit('sub' , 'X11', 'X9', 'X11')
@@ -468,6 +1081,31 @@ class AsmGen_arm64_Darwin(AsmGen):
     def _emit_xor(self, op1, op2, dst):
         self._emit_alu2('eor', op1, op2, dst)
 
+    def _emit_setcmp(self, cd, op1, op2, dst):
+        self._load('X9', op1)
+        self._load('X10', op2)
+        self._emit('cmp', 'X9', 'X10')
+        self._emit('cset', 'X11', cd)
+        self._emit('str', 'X11', self._temp(dst))
+
+    def _emit_seteq(self, op1, op2, dst):
+        self._emit_setcmp('eq', op1, op2, dst)
+
+    def _emit_setne(self, op1, op2, dst):
+        self._emit_setcmp('ne', op1, op2, dst)
+
+    def _emit_setlt(self, op1, op2, dst):
+        self._emit_setcmp('lt', op1, op2, dst)
+
+    def _emit_setle(self, op1, op2, dst):
+        self._emit_setcmp('le', op1, op2, dst)
+
+    def _emit_setgt(self, op1, op2, dst):
+        self._emit_setcmp('gt', op1, op2, dst)
+
+    def _emit_setge(self, op1, op2, dst):
+        self._emit_setcmp('ge', op1, op2, dst)
+
     def _emit_shl(self, op1, op2, dst):
         self._emit_alu2('lsl', op1, op2, dst)
 
@@ -485,25 +1123,29 @@ class AsmGen_arm64_Darwin(AsmGen):
         self._emit('ldr', 'X9', self._temp(op))
         self._emit('cbnz', 'X9', lbl)
 
-    def _emit_jlt(self, op, lbl):
-        self._emit('ldr', 'X9', self._temp(op))
-        self._emit('cmp', 'X9', '#0')
-        self._emit('b.lt', lbl)
+    def _emit_jcmp(self, cd, op1, op2, lbl):
+        self._load('X9', op1)
+        self._load('X10', op2)
+        self._emit('cmp', 'X9', 'X10')
+        self._emit(cd, lbl)
 
-    def _emit_jle(self, op, lbl):
-        self._emit('ldr', 'X9', self._temp(op))
-        self._emit('cmp', 'X9', '#0')
-        self._emit('b.le', lbl)
+    def _emit_jeq(self, op1, op2, lbl):
+        self._emit_jcmp('b.eq', op1, op2, lbl)
 
-    def _emit_jgt(self, op, lbl):
-        self._emit('ldr', 'X9', self._temp(op))
-        self._emit('cmp', 'X9', '#0')
-        self._emit('b.gt', lbl)
+    def _emit_jne(self, op1, op2, lbl):
+        self._emit_jcmp('b.ne', op1, op2, lbl)
 
-    def _emit_jge(self, op, lbl):
-        self._emit('ldr', 'X9', self._temp(op))
-        self._emit('cmp', 'X9', '#0')
-        self._emit('b.ge', lbl)
+    def _emit_jlt(self, op1, op2, lbl):
+        self._emit_jcmp('b.lt', op1, op2, lbl)
+
+    def _emit_jle(self, op1, op2, lbl):
+        self._emit_jcmp('b.le', op1, op2, lbl)
+
+    def _emit_jgt(self, op1, op2, lbl):
+        self._emit_jcmp('b.gt', op1, op2, lbl)
+
+    def _emit_jge(self, op1, op2, lbl):
+        self._emit_jcmp('b.ge', op1, op2, lbl)
 
     def _emit_param(self, i, arg):
         assert(len(self._params)+1 == i)
@@ -582,7 +1224,13 @@ class AsmGen_arm64_Darwin(AsmGen):
                 ]
 
     @classmethod
-    def lower(cls, tacs: list[TACProc | TACVar]) -> str:
+    def lower(
+        cls,
+        tacs     : list[TACProc | TACVar],
+        optlevel : int = 0,
+        report   = None,
+    ) -> str:
+        # no frame layout optimisation on this backend
         aout = [cls.lower1(tac) for tac in tacs]
         aout = [x for tac in aout for x in tac]
         return "\n".join(aout) + "\n"
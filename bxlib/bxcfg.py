@@ -0,0 +1,262 @@
+# --------------------------------------------------------------------
+import dataclasses as dc
+
+from typing import Optional as Opt
+
+from .bxmm  import MM
+from .bxtac import *
+
+# ====================================================================
+# Control-flow graphs over TAC
+
+# `jz`/`jnz` test a single operand, the others compare two of them
+CJUMPS = ('jz', 'jnz', 'jeq', 'jne', 'jlt', 'jle', 'jgt', 'jge')
+
+# instructions that leave the procedure
+EXITS = ('ret', 'tailcall', 'tailcallfatptr')
+
+INVERSE = {
+    'jz'  : 'jnz', 'jnz' : 'jz' ,
+    'jeq' : 'jne', 'jne' : 'jeq',
+    'jlt' : 'jge', 'jge' : 'jlt',
+    'jle' : 'jgt', 'jgt' : 'jle',
+}
+
+# same comparison with the operands swapped
+SWAPPED = {
+    'jeq' : 'jeq', 'jne' : 'jne',
+    'jlt' : 'jgt', 'jgt' : 'jlt',
+    'jle' : 'jge', 'jge' : 'jle',
+}
+
+# --------------------------------------------------------------------
+@dc.dataclass(eq = False)
+class BasicBlock:
+    label  : Opt[str]
+    instrs : list[TAC]            = dc.field(default_factory = list)
+    succs  : list['BasicBlock']   = dc.field(default_factory = list, repr = False)
+    preds  : list['BasicBlock']   = dc.field(default_factory = list, repr = False)
+
+    @property
+    def terminator(self) -> Opt[TAC]:
+        if self.instrs and self.instrs[-1].opcode in ('jmp',) + EXITS + CJUMPS:
+            return self.instrs[-1]
+        return None
+
+    def falls_through(self) -> bool:
+        term = self.terminator
+        return term is None or term.opcode in CJUMPS
+
+# --------------------------------------------------------------------
+@dc.dataclass(eq = False)
+class Loop:
+    header  : BasicBlock
+    blocks  : list[BasicBlock]
+    latches : list[BasicBlock]
+
+    def __contains__(self, block: BasicBlock) -> bool:
+        return any(b is block for b in self.blocks)
+
+    def exits(self) -> list[BasicBlock]:
+        aout = []
+        for block in self.blocks:
+            for succ in block.succs:
+                if succ not in self and succ not in aout:
+                    aout.append(succ)
+        return aout
+
+# --------------------------------------------------------------------
+class CFG:
+    def __init__(self, proc: TACProc):
+        self.proc   = proc
+        self.blocks = self._split(proc.tac)
+        self.relink()
+
+    @staticmethod
+    def _split(tac: list[TAC | str]) -> list[BasicBlock]:
+        blocks = [BasicBlock(None)]
+
+        for instr in tac:
+            if isinstance(instr, str):
+                blocks.append(BasicBlock(instr[:-1]))
+                continue
+            if blocks[-1].terminator is not None:
+                blocks.append(BasicBlock(None))
+            blocks[-1].instrs.append(instr)
+
+        return blocks
+
+    def relink(self):
+        # recompute edges from the terminators and the layout order,
+        # dropping the blocks that are not reachable from the entry
+        bylabel = { b.label: b for b in self.blocks if b.label is not None }
+
+        def targets(block, index):
+            term = block.terminator
+            aout = []
+            if term is not None and term.opcode not in EXITS:
+                aout.append(bylabel[term.arguments[-1]])
+            if block.falls_through() and index+1 < len(self.blocks):
+                aout.append(self.blocks[index+1])
+            return aout
+
+        reached, todo = { id(self.blocks[0]) }, [0]
+        index = { id(b): i for i, b in enumerate(self.blocks) }
+
+        while todo:
+            i = todo.pop()
+            for succ in targets(self.blocks[i], i):
+                if id(succ) not in reached:
+                    reached.add(id(succ))
+                    todo.append(index[id(succ)])
+
+        self.blocks = [b for b in self.blocks if id(b) in reached]
+
+        for block in self.blocks:
+            block.succs, block.preds = [], []
+        for i, block in enumerate(self.blocks):
+            for succ in targets(block, i):
+                if succ not in block.succs:
+                    block.succs.append(succ)
+                    succ.preds.append(block)
+
+        self._idoms = None
+
+    @property
+    def entry(self) -> BasicBlock:
+        return self.blocks[0]
+
+    def block(self, label: str) -> BasicBlock:
+        return next(b for b in self.blocks if b.label == label)
+
+    def label(self, block: BasicBlock) -> str:
+        if block.label is None:
+            block.label = MM.fresh_label()
+        return block.label
+
+    def rpo(self) -> list[BasicBlock]:
+        seen, post = { id(self.entry) }, []
+        stack = [(self.entry, iter(self.entry.succs))]
+
+        while stack:
+            block, succs = stack[-1]
+            for succ in succs:
+                if id(succ) not in seen:
+                    seen.add(id(succ))
+                    stack.append((succ, iter(succ.succs)))
+                    break
+            else:
+                stack.pop()
+                post.append(block)
+
+        return post[::-1]
+
+    # ----------------------------------------------------------------
+    # Dominators (Cooper, Harvey & Kennedy)
+
+    def idoms(self) -> dict[int, Opt[BasicBlock]]:
+        if self._idoms is not None:
+            return self._idoms
+
+        order = self.rpo()
+        rank  = { id(b): i for i, b in enumerate(order) }
+        idom  = { id(self.entry): self.entry }
+
+        def intersect(b1, b2):
+            while b1 is not b2:
+                while rank[id(b1)] > rank[id(b2)]:
+                    b1 = idom[id(b1)]
+                while rank[id(b2)] > rank[id(b1)]:
+                    b2 = idom[id(b2)]
+            return b1
+
+        changed = True
+        while changed:
+            changed = False
+            for block in order[1:]:
+                preds = [p for p in block.preds if id(p) in idom]
+                new   = preds[0]
+                for pred in preds[1:]:
+                    new = intersect(pred, new)
+                if idom.get(id(block)) is not new:
+                    idom[id(block)] = new
+                    changed = True
+
+        idom[id(self.entry)] = None
+        self._idoms = idom
+        return idom
+
+    def dominates(self, b1: BasicBlock, b2: BasicBlock) -> bool:
+        idom = self.idoms()
+        while b2 is not None:
+            if b2 is b1:
+                return True
+            b2 = idom[id(b2)]
+        return False
+
+    # ----------------------------------------------------------------
+    # Natural loops, innermost first
+
+    def loops(self) -> list[Loop]:
+        loops = dict()
+
+        for block in self.blocks:
+            for succ in block.succs:
+                if self.dominates(succ, block):
+                    loop = loops.setdefault(id(succ), Loop(succ, [succ], []))
+                    loop.latches.append(block)
+
+        for loop in loops.values():
+            body, todo = { id(loop.header) }, list(loop.latches)
+            while todo:
+                block = todo.pop()
+                if id(block) in body:
+                    continue
+                body.add(id(block))
+                todo.extend(block.preds)
+            loop.blocks = [b for b in self.blocks if id(b) in body]
+
+        return sorted(loops.values(), key = lambda x: len(x.blocks))
+
+    def walkloops(self):
+        # innermost first; loops are recomputed after each of them so
+        # that the caller may change the graph in between
+        done = set()
+        while True:
+            loops = [x for x in self.loops() if id(x.header) not in done]
+            if not loops:
+                return
+            done.add(id(loops[0].header))
+            yield loops[0]
+
+    def preheader(self, loop: Loop) -> BasicBlock:
+        # a fresh block that is the only way into the loop from outside
+        header = loop.header
+        hlabel = self.label(header)
+        pre    = BasicBlock(MM.fresh_label())
+
+        for pred in header.preds:
+            term = pred.terminator
+            if pred in loop or term is None or term.opcode in EXITS:
+                continue
+            if term.arguments[-1] == hlabel:
+                term.arguments[-1] = pre.label
+
+        index = next(i for i, b in enumerate(self.blocks) if b is header)
+        prev  = self.blocks[index-1]
+
+        self.blocks.insert(index, pre)
+        if prev in loop and prev.falls_through():
+            self.blocks.insert(index, BasicBlock(None, [TAC('jmp', [hlabel])]))
+
+        self.relink()
+        return pre
+
+    # ----------------------------------------------------------------
+    def tolist(self) -> list[TAC | str]:
+        aout = []
+        for block in self.blocks:
+            if block.label is not None:
+                aout.append(f'{block.label}:')
+            aout.extend(block.instrs)
+        return aout
@@ -0,0 +1,256 @@
+# --------------------------------------------------------------------
+from typing import Callable, Optional as Opt
+
+from .bxnesting import Nesting
+from .bxtac     import *
+
+# ====================================================================
+# Compile-time evaluation
+#
+# A bounded interpreter over TAC, with the semantics of the generated
+# code (64-bit wrapping arithmetic, `div`/`mod` truncating towards 0,
+# shift counts taken modulo 64). It gives up -- and the call is left
+# for the runtime -- as soon as the evaluation would observe anything
+# but the arguments: a global, a temporary of an enclosing frame, a
+# runtime procedure (printing) or a fat pointer. It also gives up when
+# the evaluation traps or runs out of fuel. The procedures that are
+# evaluated are thus pure on the path taken, and their results are
+# memoised. A procedure that returns nothing evaluates to 0. It runs
+# before the tail calls are introduced (any other instruction, such as
+# `tailcall`, makes it give up).
+
+class _Abort(Exception):
+    pass
+
+def _wrap(value: int) -> int:
+    return (value + 2**63) % 2**64 - 2**63
+
+def _div(x: int, y: int) -> int:
+    if y == 0 or (x == -2**63 and y == -1):
+        raise _Abort()
+    q = abs(x) // abs(y)
+    return q if (x < 0) == (y < 0) else -q
+
+UNARY = {
+    'neg' : lambda x: -x,
+    'not' : lambda x: ~x,
+}
+
+BINARY = {
+    'add'   : lambda x, y: x + y,
+    'sub'   : lambda x, y: x - y,
+    'mul'   : lambda x, y: x * y,
+    'div'   : _div,
+    'mod'   : lambda x, y: x - y * _div(x, y),
+    'and'   : lambda x, y: x & y,
+    'or'    : lambda x, y: x | y,
+    'xor'   : lambda x, y: x ^ y,
+    'shl'   : lambda x, y: x << (y & 63),
+    'shr'   : lambda x, y: x >> (y & 63),
+    'seteq' : lambda x, y: int(x == y),
+    'setne' : lambda x, y: int(x != y),
+    'setlt' : lambda x, y: int(x <  y),
+    'setle' : lambda x, y: int(x <= y),
+    'setgt' : lambda x, y: int(x >  y),
+    'setge' : lambda x, y: int(x >= y),
+}
+
+TESTS = {
+    'jz'  : lambda x   : x == 0,
+    'jnz' : lambda x   : x != 0,
+    'jeq' : lambda x, y: x == y,
+    'jne' : lambda x, y: x != y,
+    'jlt' : lambda x, y: x <  y,
+    'jle' : lambda x, y: x <= y,
+    'jgt' : lambda x, y: x >  y,
+    'jge' : lambda x, y: x >= y,
+}
+
+class Evaluator:
+    FUEL  = 200_000             # instructions per evaluation
+    DEPTH = 200                 # nested calls
+
+    def __init__(self, tac: list[TACProc | TACVar]):
+        self.procs = { x.name: x for x in tac if isinstance(x, TACProc) }
+        self.code  = dict()     # name -> (instructions, label -> index)
+        self.memo  = dict()     # (name, arguments) -> result
+        self.fuel  = 0
+
+    def _code(self, proc: TACProc) -> tuple[list, dict[str, int]]:
+        if proc.name not in self.code:
+            instrs, labels = [], dict()
+            for instr in proc.tac:
+                if isinstance(instr, str):
+                    labels[instr[:-1]] = len(instrs)
+                else:
+                    instrs.append(instr)
+            self.code[proc.name] = (instrs, labels)
+        return self.code[proc.name]
+
+    def _call(self, name: str, args: tuple[int], depth: int) -> int:
+        if (name, args) in self.memo:
+            return self.memo[name, args]
+
+        proc = self.procs.get(name)
+        if proc is None or len(args) != len(proc.arguments) or depth > self.DEPTH:
+            raise _Abort()
+
+        own = proc.depth + 1
+        env = { f'{x}:{own}': v for x, v in zip(proc.arguments, args) }
+
+        def value(x):
+            if not is_temp(x):
+                return x
+            if x not in env:
+                raise _Abort()
+            return env[x]
+
+        def store(temp, v):
+            if temp.startswith('@') or split_temp(temp)[1] not in (None, own):
+                raise _Abort()
+            env[temp] = _wrap(v)
+
+        instrs, labels = self._code(proc)
+        params, pc = dict(), 0
+
+        while True:
+            self.fuel -= 1
+            if self.fuel < 0:
+                raise _Abort()
+            if pc == len(instrs):
+                result = 0
+                break
+
+            instr, pc = instrs[pc], pc + 1
+            args_     = instr.arguments
+
+            match instr.opcode:
+                case 'const':
+                    store(instr.result, args_[0])
+                case 'copy':
+                    store(instr.result, value(args_[0]))
+                case op if op in UNARY:
+                    store(instr.result, UNARY[op](value(args_[0])))
+                case op if op in BINARY:
+                    store(instr.result, BINARY[op](value(args_[0]), value(args_[1])))
+                case 'jmp':
+                    pc = labels[args_[0]]
+                case op if op in TESTS:
+                    if TESTS[op](*map(value, args_[:-1])):
+                        pc = labels[args_[-1]]
+                case 'param':
+                    params[args_[0]] = value(args_[1])
+                case 'call':
+                    callee, count = args_
+                    if set(params) != set(range(1, count + 1)):
+                        raise _Abort()
+                    result = self._call(callee, tuple(params[i+1] for i in range(count)), depth + 1)
+                    params = dict()
+                    if instr.result is not None:
+                        store(instr.result, result)
+                case 'ret':
+                    result = value(args_[0]) if args_ else 0
+                    break
+                case _:
+                    raise _Abort()
+
+        self.memo[name, args] = result
+        return result
+
+    def evaluate(self, name: str, args: list[int]) -> Opt[int]:
+        # the result of a call, or None when it cannot be evaluated
+        self.fuel = self.FUEL
+        try:
+            return self._call(name, tuple(args), 0)
+        except (_Abort, RecursionError):
+            return None
+
+# ====================================================================
+# Folding of the calls with constant arguments
+#
+# The arguments of the direct calls are traced, in the caller, to the
+# private temporaries that a single `const` (or a copy of one) defines.
+# A call whose arguments are all known and that the evaluator completes
+# becomes a `const` of its result -- or is removed when nothing is
+# returned -- and its `param` instructions are dropped. The constants
+# that fold introduces are traced in turn.
+#
+# The callees are evaluated from their current bodies, as rewritten by
+# the passes that ran before (lambda lifting, and the folding of the
+# previous procedures): this is sound as long as these passes -- or
+# the specialiser and the inliner, were they moved before -- preserve
+# the semantics of each procedure. One evaluator serves all the call
+# sites of the program: its memo only depends on the callees and their
+# arguments, and its fuel is reset for each call site.
+
+class CallFolder:
+    def __init__(
+        self,
+        tac    : list[TACProc | TACVar],
+        report : Opt[Callable[[str], None]] = None,
+    ):
+        self.tac       = tac
+        self.report    = report or (lambda _: None)
+        self.nesting   = Nesting(tac)
+        self.evaluator = Evaluator(tac)
+
+    def _fold(self, proc: TACProc) -> int:
+        instrs = [x for x in proc.tac if not isinstance(x, str)]
+        ndefs  = dict()
+        for instr in instrs:
+            if instr.result is not None:
+                ndefs[instr.result] = ndefs.get(instr.result, 0) + 1
+
+        def single(temp):
+            return ndefs.get(temp) == 1 and self.nesting.is_private(proc.name, temp)
+
+        consts, params, drop, folded = dict(), [], set(), dict()
+
+        for instr in instrs:
+            match instr.opcode:
+                case 'const' if single(instr.result):
+                    consts[instr.result] = instr.arguments[0]
+                case 'copy' if single(instr.result) and instr.arguments[0] in consts:
+                    consts[instr.result] = consts[instr.arguments[0]]
+                case 'param':
+                    params.append(instr)
+                case 'call' | 'callfatptr':
+                    callee, count = instr.arguments
+                    if instr.opcode == 'call' and callee in self.nesting.procs \
+                            and sorted(x.arguments[0] for x in params) == list(range(1, count + 1)):
+                        args = {
+                            x.arguments[0]: (
+                                consts.get(x.arguments[1]) if is_temp(x.arguments[1])
+                                else x.arguments[1]
+                            )
+                            for x in params
+                        }
+                        args = [args[i+1] for i in range(count)]
+                        if None not in args:
+                            result = self.evaluator.evaluate(callee, args)
+                            if result is not None:
+                                drop.update(id(x) for x in params)
+                                folded[id(instr)] = result
+                                if instr.result is not None and single(instr.result):
+                                    consts[instr.result] = result
+                                self.report(
+                                    f'fold: {proc.name}: {callee}'
+                                    f'({", ".join(map(str, args))}) = {result}'
+                                )
+                    params = []
+
+        drop |= folded.keys()
+        aout  = []
+        for instr in proc.tac:
+            if isinstance(instr, str) or id(instr) not in drop:
+                aout.append(instr)
+            elif id(instr) in folded and instr.result is not None:
+                aout.append(TAC('const', [folded[id(instr)]], instr.result))
+        proc.tac = aout
+
+        return len(folded)
+
+    def run(self) -> list[TACProc | TACVar]:
+        for proc in self.nesting.procs.values():
+            self._fold(proc)
+        return self.tac
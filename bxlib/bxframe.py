@@ -0,0 +1,470 @@
+# --------------------------------------------------------------------
+import bisect
+import dataclasses as dc
+import heapq
+
+from typing import Optional as Opt
+
+from .bxcfg     import *
+from .bxnesting import Nesting
+from .bxtac     import *
+
+# ====================================================================
+# Stack frame layout and register allocation
+#
+# The temporaries of a frame that are only accessed from their owner
+# are given registers by a linear scan over their live intervals, and
+# the ones left in memory get slots by colouring the same intervals:
+# two temporaries whose intervals do not overlap share a slot. The
+# static link and the captured temporaries keep the fixed leading slots
+# given by `Nesting.frame`.
+# A fat pointer record (3 slots) lives as long as one of the private
+# temporaries its pointer is copied to; records are shared on these
+# lifetimes, and never when the pointer reaches another frame
+# temporaries (a callee only uses it for the duration of the call).
+#
+# Each instruction `i` reads its operands at point 2i and writes its
+# result at point 2i+1, so that a result may reuse the location of an
+# operand read by the same instruction. `param` operands are read by
+# the back end when the call is emitted, and live until then.
+#
+# The frame also holds a *display*: the frame pointers of the ancestors
+# more than one static link away that are reached from a loop or more
+# than once. They are computed on entry (the static chain of a frame
+# does not change), so that reaching such an ancestor costs one load.
+
+CALLS = ('call', 'callfatptr', 'tailcall', 'tailcallfatptr')
+
+@dc.dataclass
+class Frame:
+    slots   : dict[str, int]            # temporary -> slot index
+    regs    : dict[str, str]            # temporary -> register
+    saves   : dict[int, list[str]]      # id(call) -> caller-saved registers to preserve
+    spills  : dict[str, int]            # saved register -> slot index
+    display : dict[int, int]            # static link distance -> slot index
+    before  : int                       # size (in slots) without sharing
+    size    : int                       # size (in slots)
+
+# --------------------------------------------------------------------
+class FrameLayout:
+    def __init__(self, proc: TACProc, nesting: Nesting):
+        self.proc    = proc
+        self.nesting = nesting
+        self.fixed   = nesting.frame(proc.name)
+        self.stack   = set(proc.arguments[6:]) - set(self.fixed)
+
+    def key(self, temp: str) -> Opt[str]:
+        # the slot name of a temporary of this frame (None for the
+        # temporaries that are not given a slot here)
+        if not is_temp(temp) or self.nesting.distance(self.proc.name, temp) != 0:
+            return None
+        base, _ = split_temp(temp)
+        if base in self.fixed or base in self.stack:
+            return None
+        return base
+
+    def _intervals(self, cfg: CFG, trees = None) -> dict[str, list[int]]:
+        # with expression trees (see bxisel), the leaves of a tree are
+        # read by its root, and the folded definitions are not emitted
+        def uses(instr):
+            reads = trees.reads(instr) if trees is not None else None
+            if reads is None:
+                reads = instr.arguments
+            return [self.key(x) for x in reads if self.key(x) is not None]
+
+        def define(instr):
+            if instr.result is None or (trees is not None and id(instr) in trees.folded):
+                return None
+            return self.key(instr.result)
+
+        liveout = { id(b): set() for b in cfg.blocks }
+        livein  = { id(b): set() for b in cfg.blocks }
+
+        changed = True
+        while changed:
+            changed = False
+            for block in cfg.blocks[::-1]:
+                out = set()
+                for succ in block.succs:
+                    out |= livein[id(succ)]
+                live = set(out)
+                for instr in block.instrs[::-1]:
+                    live.discard(define(instr))
+                    live.update(uses(instr))
+                if out != liveout[id(block)] or live != livein[id(block)]:
+                    liveout[id(block)], livein[id(block)] = out, live
+                    changed = True
+
+        intervals = dict()
+        self.calls   = []               # (point, call)
+        self.weights = dict()           # uses, weighted by loop depth
+
+        def extend(key, point):
+            if key is None:
+                return
+            if key not in intervals:
+                intervals[key] = [point, point]
+            else:
+                intervals[key][0] = min(intervals[key][0], point)
+                intervals[key][1] = max(intervals[key][1], point)
+
+        nesting = { id(b): 0 for b in cfg.blocks }
+        for loop in cfg.loops():
+            for block in loop.blocks:
+                nesting[id(block)] += 1
+
+        for argument in self.proc.arguments[:6]:
+            extend(self.key(argument), -1)
+
+        index, params = 0, []
+        for block in cfg.blocks:
+            if not block.instrs:
+                continue
+            first, last = index, index + len(block.instrs) - 1
+            for key in livein[id(block)]:
+                extend(key, 2*first)
+            for key in liveout[id(block)]:
+                extend(key, 2*last+1)
+
+            weight = 10 ** min(nesting[id(block)], 4)
+            for instr in block.instrs:
+                for key in uses(instr):
+                    extend(key, 2*index)
+                extend(define(instr), 2*index+1)
+                for key in uses(instr) + [define(instr)]:
+                    if key is not None:
+                        self.weights[key] = self.weights.get(key, 0) + weight
+                if instr.opcode == 'param':
+                    params.extend(uses(instr))
+                elif instr.opcode in CALLS:
+                    for key in params:
+                        extend(key, 2*index)
+                    params = []
+                    self.calls.append((2*index, instr))
+                index += 1
+
+        return intervals
+
+    def _lifetimes(self, records: set[str], intervals) -> dict[str, Opt[list[int]]]:
+        # record -> live range (None when the pointer escapes)
+        holders = { k: k for k in records }
+        escaped = { k for k in records if not self.nesting.is_private(self.proc.name, k) }
+
+        changed = True
+        while changed:
+            changed = False
+            for instr in self.proc.tac:
+                if isinstance(instr, str) or instr.opcode != 'copy':
+                    continue
+                src = instr.arguments[0]
+                if not is_temp(src) or self.key(src) not in holders:
+                    continue
+                record, dst = holders[self.key(src)], self.key(instr.result)
+                if dst is None or not self.nesting.is_private(self.proc.name, instr.result):
+                    escape = { record }
+                elif dst not in holders:
+                    holders[dst] = record
+                    changed = True
+                    continue
+                elif holders[dst] != record:
+                    escape = { record, holders[dst] }
+                else:
+                    continue
+                if not escape <= escaped:
+                    escaped |= escape
+                    changed = True
+
+        lifetimes = { k: None for k in escaped }
+        for key, record in holders.items():
+            if record in escaped or key not in intervals:
+                continue
+            start, end = intervals[key]
+            if record in lifetimes:
+                start = min(start, lifetimes[record][0])
+                end   = max(end  , lifetimes[record][1])
+            lifetimes[record] = [start, end]
+        return lifetimes
+
+    def _display(self, cfg: CFG) -> list[int]:
+        counts = dict()
+        inloop = { id(b) for loop in cfg.loops() for b in loop.blocks }
+
+        for block in cfg.blocks:
+            for instr in block.instrs:
+                hops = [self.nesting.distance(self.proc.name, x) for x in temps_of(instr)]
+                if instr.opcode in ('call', 'fatptr', 'tailcall'):
+                    hops.append(instr.link_depth)
+                for h in hops:
+                    if h is not None and h > 1:
+                        counts[h] = counts.get(h, 0) + (2 if id(block) in inloop else 1)
+
+        return sorted(h for h, n in counts.items() if n > 1)
+
+    def _hints(self, params) -> dict[str, list[str]]:
+        # registers that save a move: the incoming ones of the arguments,
+        # and the outgoing ones of the call parameters
+        hints = dict()
+        for i, argument in enumerate(self.proc.arguments[:len(params)]):
+            if self.key(argument) is not None:
+                hints.setdefault(self.key(argument), []).append(params[i])
+        for instr in self.proc.tac:
+            if isinstance(instr, str) or instr.opcode != 'param':
+                continue
+            index, value = instr.arguments
+            if index <= len(params) and is_temp(value) and self.key(value) is not None:
+                hints.setdefault(self.key(value), []).append(params[index-1])
+        return hints
+
+    def _allocate(self, intervals, keys, caller, callee, hints) -> dict[str, str]:
+        # linear scan (Poletto & Sarkar); the intervals that span a call
+        # prefer callee-saved registers, the other ones their hints, and
+        # the lightest interval is the one that is spilled when no
+        # register is left
+        points = [p for p, _ in self.calls]
+        regs   = dict()
+        free   = set(caller) | set(callee)
+        active = []
+
+        def crossing(key):
+            start, end = intervals[key]
+            i = bisect.bisect_right(points, start)
+            return i < len(points) and points[i] < end
+
+        for key in sorted(keys, key = lambda k: (intervals[k][0], k)):
+            start, end = intervals[key]
+
+            for other in [k for k in active if intervals[k][1] < start]:
+                active.remove(other)
+                free.add(regs[other])
+
+            if crossing(key):
+                prefs = callee + caller
+            else:
+                prefs = [r for r in hints.get(key, []) if r in caller] + caller + callee
+            reg = next((r for r in prefs if r in free), None)
+
+            if reg is None:
+                if not active:
+                    continue
+                victim = min(active, key = lambda k: (self.weights[k], -intervals[k][1]))
+                if self.weights[victim] >= self.weights[key]:
+                    continue
+                active.remove(victim)
+                reg = regs.pop(victim)
+
+            free.discard(reg)
+            regs[key] = reg
+            active.append(key)
+
+        return regs
+
+    def run(
+        self,
+        caller : tuple[str] = (),
+        callee : tuple[str] = (),
+        params : tuple[str] = (),
+        pinned : tuple[str] = (),
+        trees  = None,
+    ) -> Frame:
+        cfg     = CFG(self.proc)
+        records = set()
+        naive   = dict()
+
+        for instr in self.proc.tac:
+            if isinstance(instr, str):
+                continue
+            for temp in temps_of(instr):
+                key = self.key(temp)
+                if key is not None:
+                    naive.setdefault(key, 1)
+            if instr.opcode == 'fatptr' and self.key(instr.result) is not None:
+                records.add(self.key(instr.result))
+                naive[self.key(instr.result)] = 3
+        for argument in self.proc.arguments[:6]:
+            if self.key(argument) is not None:
+                naive.setdefault(self.key(argument), 1)
+
+        before    = len(self.fixed) + sum(naive.values())
+        intervals = self._intervals(cfg, trees)
+        regs      = self._allocate(
+            intervals, [k for k in intervals if k not in records],
+            list(caller), list(callee), self._hints(params),
+        )
+
+        # slots for the temporaries left in memory
+        slots  = dict()
+        free   = []
+        active = []
+        nslots = len(self.fixed)
+
+        order = sorted(
+            (k for k in intervals if k not in records and k not in regs),
+            key = lambda k: (intervals[k][0], k),
+        )
+
+        for key in order:
+            start, end = intervals[key]
+            while active and active[0][0] < start:
+                _, slot = heapq.heappop(active)
+                heapq.heappush(free, slot)
+            if free:
+                slot = heapq.heappop(free)
+            else:
+                slot, nslots = nslots, nslots + 1
+            slots[key] = slot
+            heapq.heappush(active, (end, slot))
+
+        lifetimes = self._lifetimes(records, intervals)
+        free, active = [], []
+
+        for key in sorted(records, key = lambda k: ((lifetimes[k] or [-2])[0], k)):
+            if lifetimes[key] is None:
+                slots[key], nslots = nslots, nslots + 3
+                continue
+            start, end = lifetimes[key]
+            while active and active[0][0] < start:
+                _, slot = heapq.heappop(active)
+                heapq.heappush(free, slot)
+            if free:
+                slot = heapq.heappop(free)
+            else:
+                slot, nslots = nslots, nslots + 3
+            slots[key] = slot
+            heapq.heappush(active, (end, slot))
+
+        # caller-saved registers live across a call are saved around it,
+        # callee-saved registers in the prologue
+        saves = dict()
+        for point, call in self.calls:
+            saves[id(call)] = sorted({
+                r for k, r in regs.items()
+                if r in caller and intervals[k][0] < point < intervals[k][1]
+            })
+
+        # the registers pinned to shared variables are saved on entry
+        spills = dict()
+        for reg in pinned:
+            spills[reg], nslots = nslots, nslots + 1
+        for reg in list(callee) + list(caller):
+            if reg in regs.values() and (reg in callee or any(reg in x for x in saves.values())):
+                spills[reg], nslots = nslots, nslots + 1
+
+        display = dict()
+        for hops in self._display(cfg):
+            display[hops], nslots = nslots, nslots + 1
+
+        return Frame(slots, regs, saves, spills, display, before, nslots)
+
+# ====================================================================
+# Registers shared between a procedure and its nested procedures
+#
+# The *group* of a procedure P is the set of its nested procedures that
+# never escape as fat pointers and that are only called (directly) from
+# P or from the group: whenever one of them runs, the innermost frame of
+# P on the stack is the one of its static chain. A variable of P that is
+# only accessed from P and its group can then live in a callee-saved
+# register instead of the frame of P: P saves the register on entry,
+# the procedures of the group do not allocate it, and the other
+# procedures preserve it. This only pays off for the variables accessed
+# from loops, or from procedures called from loops.
+
+class SharedRegisters:
+    MAXSHARED = 2               # registers given to the variables of a procedure
+    MINWEIGHT = 10              # weighted accesses of a shared variable
+
+    def __init__(self, tac: list[TACProc | TACVar], nesting: Nesting, registers: list[str]):
+        self.tac       = tac
+        self.nesting   = nesting
+        self.registers = registers
+        self.shared    = dict()         # (owner, variable) -> register
+        self.pinned    = dict()         # owner -> registers
+        self.reserved  = dict()         # group member -> registers
+
+    def _instrs(self, name: str) -> list[TAC]:
+        return [x for x in self.nesting.procs[name].tac if not isinstance(x, str)]
+
+    def _group(self, name: str, callers: dict[str, set[str]], addressed: set[str]) -> set[str]:
+        group = { x for x in self.nesting.descendants(name) if x not in addressed }
+
+        changed = True
+        while changed:
+            changed = False
+            for member in sorted(group):
+                if not callers.get(member, set()) <= group | { name }:
+                    group.discard(member)
+                    changed = True
+
+        return group
+
+    def _weights(self) -> dict[tuple[str, str], int]:
+        # accesses to the captured variables, weighted by loop nesting
+        # (and by the one of the call sites for the accesses from nested
+        # procedures)
+        blocks, hot = dict(), dict()
+        for name, proc in self.nesting.procs.items():
+            cfg     = CFG(proc)
+            inloops = dict()
+            for loop in cfg.loops():
+                for block in loop.blocks:
+                    inloops[id(block)] = inloops.get(id(block), 0) + 1
+            blocks[name] = [(b, 10 ** min(inloops.get(id(b), 0), 4)) for b in cfg.blocks]
+            for block, weight in blocks[name]:
+                for instr in block.instrs:
+                    if instr.opcode in ('call', 'tailcall'):
+                        callee = instr.arguments[0]
+                        hot[callee] = max(hot.get(callee, 1), weight)
+
+        weights = dict()
+        for name in self.nesting.procs:
+            for block, weight in blocks[name]:
+                for instr in block.instrs:
+                    for temp in temps_of(instr):
+                        var = self.nesting.resolve(name, temp)
+                        if var[0] is None:
+                            continue
+                        scale = hot.get(name, 1) if var[0] != name else 1
+                        weights[var] = weights.get(var, 0) + weight * scale
+        return weights
+
+    def run(self) -> dict[tuple[str, str], str]:
+        callers, addressed, records, accessors = dict(), set(), set(), dict()
+
+        for name in self.nesting.procs:
+            for instr in self._instrs(name):
+                if instr.opcode in ('call', 'tailcall'):
+                    callers.setdefault(instr.arguments[0], set()).add(name)
+                elif instr.opcode == 'fatptr':
+                    addressed.add(instr.arguments[0])
+                    records.add(self.nesting.resolve(name, instr.result))
+                for temp in temps_of(instr):
+                    var = self.nesting.resolve(name, temp)
+                    if var[0] is not None and var[0] != name:
+                        accessors.setdefault(var, set()).add(name)
+
+        weights = self._weights()
+        taken   = set()
+
+        for name in sorted(self.nesting.procs, key = lambda x: (self.nesting.procs[x].depth, x)):
+            if name in taken or not self.nesting.captured[name]:
+                continue
+
+            group = self._group(name, callers, addressed) - taken
+            cands = [
+                (name, x) for x in self.nesting.captured[name]
+                if (name, x) not in records and accessors.get((name, x), set()) <= group
+                and weights.get((name, x), 0) >= self.MINWEIGHT
+            ]
+            cands = sorted(cands, key = lambda v: (-weights.get(v, 0), v))
+
+            regs = []
+            for var, reg in zip(cands[:self.MAXSHARED], self.registers):
+                self.shared[var] = reg
+                regs.append(reg)
+
+            if regs:
+                self.pinned[name] = regs
+                for member in group:
+                    self.reserved[member] = regs
+                taken |= group
+
+        return self.shared
@@ -0,0 +1,230 @@
+# --------------------------------------------------------------------
+from typing import Callable, Optional as Opt
+
+from .bxmm      import MM
+from .bxnesting import Nesting
+from .bxtac     import *
+
+# ====================================================================
+# Procedure inlining
+#
+# A callee body moved into a caller keeps its references to the frames
+# of the enclosing procedures unchanged: the suffix of "%x:d" is the
+# depth of the owner, and the owner is found on the static chain of the
+# caller as well (the callee parent is an ancestor of the caller, or
+# the caller itself). Only the callee own temporaries are renamed, and
+# the link depths of the calls and fat pointers of the body are shifted
+# by the difference of depth between the caller and the callee.
+
+class Inliner:
+    SMALL  = 12                 # always inlined (instructions)
+    ONCE   = 120                # inlined when there is a single call site
+    GROWTH = 2000               # maximal size of a caller
+    ROUNDS = 3
+
+    def __init__(
+        self,
+        tac    : list[TACProc | TACVar],
+        report : Opt[Callable[[str], None]] = None,
+    ):
+        self.tac     = tac
+        self.report   = report or (lambda _: None)
+        self.inlined  = 0
+        self.rejected = set()
+
+    @staticmethod
+    def _size(proc: TACProc) -> int:
+        return sum(1 for x in proc.tac if not isinstance(x, str))
+
+    def _callees(self, proc: TACProc) -> list[str]:
+        return [
+            x.arguments[0] for x in proc.tac
+            if not isinstance(x, str)
+            and x.opcode in ('call', 'fatptr')
+            and x.arguments[0] in self.nesting.procs
+        ]
+
+    def _recursive(self) -> set[str]:
+        graph = { n: set(self._callees(p)) for n, p in self.nesting.procs.items() }
+        aout  = set()
+
+        for name in graph:
+            seen, todo = set(), list(graph[name])
+            while todo:
+                callee = todo.pop()
+                if callee == name:
+                    aout.add(name)
+                    break
+                if callee not in seen:
+                    seen.add(callee)
+                    todo.extend(graph[callee])
+
+        return aout
+
+    def _decide(self, caller: TACProc, callee: str) -> tuple[bool, str]:
+        proc = self.nesting.procs[callee]
+        size = self._size(proc)
+
+        if callee == 'main' or callee == caller.name:
+            return False, 'recursive call'
+        if self.nesting.children[callee]:
+            return False, 'has nested procedures'
+        if callee in self.recursive:
+            return False, 'recursive'
+        if self._size(caller) + size > self.GROWTH:
+            return False, f'caller too large ({self._size(caller)})'
+        if size <= self.SMALL:
+            return True, f'small (size {size})'
+        if self.sites.get(callee, 0) == 1 and callee not in self.addressed and size <= self.ONCE:
+            return True, f'single call site (size {size})'
+        return False, f'too large (size {size}, {self.sites.get(callee, 0)} call sites)'
+
+    def _body(self, caller: TACProc, callee: TACProc, call: TAC, args: list[str]) -> list[TAC | str]:
+        # the callee body, renamed for the caller frame
+        own    = callee.depth + 1
+        shift  = caller.depth - callee.depth
+        end    = MM.fresh_label()
+        temps  = dict()
+        labels = dict()
+
+        for argument, value in zip(callee.arguments, args):
+            temps[f'{argument}:{own}'] = value
+
+        def temp(x):
+            if not is_temp(x) or x.startswith('@'):
+                return x
+            _, depth = split_temp(x)
+            if depth is not None and depth != own:
+                return x
+            if x not in temps:
+                temps[x] = MM.fresh_temporary()
+            return temps[x]
+
+        def label(x):
+            if x not in labels:
+                labels[x] = MM.fresh_label()
+            return labels[x]
+
+        aout = []
+
+        for instr in callee.tac:
+            if isinstance(instr, str):
+                aout.append(f'{label(instr[:-1])}:')
+                continue
+
+            match instr.opcode:
+                case 'ret':
+                    if instr.arguments and call.result is not None:
+                        aout.append(TAC('copy', [temp(instr.arguments[0])], call.result))
+                    aout.append(TAC('jmp', [end]))
+
+                case 'jmp' | 'jz' | 'jnz' | 'jeq' | 'jne' | 'jlt' | 'jle' | 'jgt' | 'jge':
+                    arguments = [temp(x) for x in instr.arguments[:-1]]
+                    aout.append(TAC(instr.opcode, arguments + [label(instr.arguments[-1])]))
+
+                case 'call' | 'fatptr':
+                    link_depth = instr.link_depth
+                    if link_depth is not None:
+                        link_depth += shift
+                    aout.append(TAC(
+                        instr.opcode,
+                        list(instr.arguments),
+                        temp(instr.result) if instr.result is not None else None,
+                        link_depth,
+                    ))
+
+                case _:
+                    aout.append(TAC(
+                        instr.opcode,
+                        [temp(x) for x in instr.arguments],
+                        temp(instr.result) if instr.result is not None else None,
+                        instr.link_depth,
+                    ))
+
+        aout.append(f'{end}:')
+        return aout
+
+    def _inline_in(self, caller: TACProc) -> bool:
+        aout, params, changed = [], [], False
+
+        for instr in caller.tac:
+            if not isinstance(instr, str) and instr.opcode == 'param':
+                params.append(len(aout))
+            if isinstance(instr, str) or instr.opcode != 'call' \
+                    or instr.arguments[0] not in self.nesting.procs:
+                aout.append(instr)
+                if not isinstance(instr, str) and instr.opcode in ('call', 'callfatptr'):
+                    params = []
+                continue
+
+            callee = instr.arguments[0]
+            ok, reason = self._decide(caller, callee)
+            if not ok:
+                if (caller.name, callee) not in self.rejected:
+                    self.rejected.add((caller.name, callee))
+                    self.report(f'inline: {callee} not inlined in {caller.name}: {reason}')
+                aout.append(instr); params = []
+                continue
+            self.report(f'inline: {callee} inlined in {caller.name}: {reason}')
+
+            # parameters are read at the time of the call
+            proc  = self.nesting.procs[callee]
+            count = instr.arguments[1]
+            sites = params[len(params)-count:] if count else []
+            args  = [MM.fresh_temporary() for _ in range(count)]
+            moves = [TAC('copy', [aout[i].arguments[1]], a) for i, a in zip(sites, args)]
+
+            for i in sorted(sites, reverse = True):
+                del aout[i]
+
+            aout.extend(moves)
+            aout.extend(self._body(caller, proc, instr, args))
+            params = []; changed = True
+            self.inlined += 1
+
+        caller.tac = aout
+        return changed
+
+    def _prune(self) -> list[TACProc | TACVar]:
+        # procedures that are no longer referenced from `main`
+        reached, todo = { 'main' }, [ 'main' ]
+        while todo:
+            for callee in self._callees(self.nesting.procs[todo.pop()]):
+                if callee not in reached:
+                    reached.add(callee)
+                    todo.append(callee)
+
+        aout = []
+        for decl in self.tac:
+            if isinstance(decl, TACProc) and decl.name not in reached:
+                self.report(f'inline: {decl.name} removed')
+                continue
+            aout.append(decl)
+        return aout
+
+    def run(self) -> list[TACProc | TACVar]:
+        for _ in range(self.ROUNDS):
+            self.nesting   = Nesting(self.tac)
+            self.recursive = self._recursive()
+            self.sites     = dict()
+            self.addressed = set()
+
+            for proc in self.nesting.procs.values():
+                for instr in proc.tac:
+                    if isinstance(instr, str):
+                        continue
+                    if instr.opcode == 'call':
+                        self.sites[instr.arguments[0]] = self.sites.get(instr.arguments[0], 0) + 1
+                    if instr.opcode == 'fatptr':
+                        self.addressed.add(instr.arguments[0])
+
+            changed = False
+            for proc in self.nesting.procs.values():
+                changed = self._inline_in(proc) or changed
+            if not changed:
+                break
+
+        self.nesting = Nesting(self.tac)
+        if 'main' in self.nesting.procs:
+            self.tac = self._prune()
+        return self.tac
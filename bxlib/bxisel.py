@@ -0,0 +1,145 @@
+# --------------------------------------------------------------------
+import dataclasses as dc
+
+from typing import Callable, Optional as Opt
+
+from .bxcfg     import *
+from .bxnesting import Nesting
+from .bxtac     import *
+
+# ====================================================================
+# Expression trees for instruction selection
+#
+# The instructions of a basic block are grouped into trees: a temporary
+# of the frame that is defined once and read once, later in the same
+# block, is not materialised when none of the leaves of its definition
+# is written in between (and no call occurs in between) -- its
+# definition becomes an operand of its reader. A node has at most one
+# operand that is not a leaf, so that a tree can be evaluated in a
+# single register by the back end.
+
+FOLDABLE = ('const', 'copy', 'neg', 'not', 'add', 'sub', 'mul',
+            'and', 'or', 'xor', 'shl', 'shr')
+
+ROOTS    = FOLDABLE[1:] + ('jz', 'jnz') + CJUMPS[2:] + \
+           ('seteq', 'setne', 'setlt', 'setle', 'setgt', 'setge')
+
+# --------------------------------------------------------------------
+@dc.dataclass(eq = False)
+class Node:
+    opcode : str                        # TAC opcode, 'temp' or 'imm'
+    kids   : list['Node'] = dc.field(default_factory = list)
+    value  : Opt[str | int] = None      # for leaves
+
+    @property
+    def leaf(self) -> bool:
+        return self.opcode in ('temp', 'imm')
+
+    def leaves(self) -> list['Node']:
+        if self.leaf:
+            return [self]
+        return [x for kid in self.kids for x in kid.leaves()]
+
+# --------------------------------------------------------------------
+class Trees:
+    def __init__(self, proc: TACProc, nesting: Nesting, key: Callable[[str], Opt[str]]):
+        self.proc    = proc
+        self.nesting = nesting
+        self.key     = key              # temporaries that may be folded
+        self.roots   = dict()           # id(instr) -> Node
+        self.folded  = set()            # id(instr) of the folded definitions
+
+    def _var(self, temp: str):
+        return self.nesting.resolve(self.proc.name, temp)
+
+    def _counts(self, blocks: list[BasicBlock]) -> tuple[dict, dict]:
+        defs, uses = dict(), dict()
+        for block in blocks:
+            for instr in block.instrs:
+                for x in instr.arguments:
+                    if is_temp(x):
+                        uses[self._var(x)] = uses.get(self._var(x), 0) + 1
+                if instr.result is not None:
+                    defs[self._var(instr.result)] = defs.get(self._var(instr.result), 0) + 1
+        return defs, uses
+
+    def _foldable(self, instr: TAC, defs: dict, uses: dict) -> bool:
+        if instr.opcode not in FOLDABLE or instr.result is None:
+            return False
+        if self.key(instr.result) is None or split_temp(instr.result)[0] in self.proc.arguments:
+            return False
+        var = self._var(instr.result)
+        if defs.get(var) != 1 or uses.get(var) != 1:
+            return False
+        match instr.opcode:
+            case 'const':
+                return fits32(instr.arguments[0])
+            case 'shl' | 'shr':
+                return isinstance(instr.arguments[1], int)
+        return True
+
+    def _root(self, instr: TAC) -> bool:
+        if instr.opcode in ('shl', 'shr'):
+            return isinstance(instr.arguments[1], int)
+        return instr.opcode in ROOTS
+
+    def _block(self, block: BasicBlock, defs: dict, uses: dict):
+        pending = dict()                # variable -> (instr, node)
+
+        for instr in block.instrs:
+            node = None
+
+            if instr.opcode == 'const':
+                node = Node('imm', value = instr.arguments[0])
+
+            elif self._root(instr):
+                kids, inner = [], False
+                for x in instr.arguments:
+                    if isinstance(x, int):
+                        kids.append(Node('imm', value = x))
+                    elif not is_temp(x):
+                        continue        # label of a jump
+                    elif self._var(x) in pending and \
+                            (pending[self._var(x)][1].leaf or not inner):
+                        producer, kid = pending.pop(self._var(x))
+                        self.folded.add(id(producer))
+                        inner = inner or not kid.leaf
+                        kids.append(kid)
+                    else:
+                        kids.append(Node('temp', value = x))
+                node = kids[0] if instr.opcode == 'copy' else Node(instr.opcode, kids)
+
+            # the pending definitions whose leaves are written here
+            if instr.opcode in ('call', 'callfatptr', 'tailcall', 'tailcallfatptr'):
+                pending.clear()
+            elif instr.result is not None:
+                written = self._var(instr.result)
+                for var in [
+                    v for v, (_, n) in pending.items()
+                    if any(x.opcode == 'temp' and self._var(x.value) == written for x in n.leaves())
+                ]:
+                    del pending[var]
+
+            if node is None:
+                continue
+            if self._foldable(instr, defs, uses):
+                pending[self._var(instr.result)] = (instr, node)
+            if instr.opcode != 'const':
+                self.roots[id(instr)] = node
+
+    def run(self) -> 'Trees':
+        cfg = CFG(self.proc)
+        defs, uses = self._counts(cfg.blocks)
+        for block in cfg.blocks:
+            self._block(block, defs, uses)
+        self.roots = { k: v for k, v in self.roots.items() if k not in self.folded }
+        return self
+
+    def reads(self, instr: TAC) -> Opt[list[str]]:
+        # temporaries read by the code of `instr` (None when the
+        # instruction is emitted on its own)
+        if id(instr) in self.folded:
+            return []
+        if id(instr) not in self.roots:
+            return None
+        return [x.value for x in self.roots[id(instr)].leaves() if x.opcode == 'temp']
@@ -0,0 +1,226 @@
+# --------------------------------------------------------------------
+from typing import Callable, Optional as Opt
+
+from .bxmm      import MM
+from .bxnesting import Nesting
+from .bxtac     import *
+
+# ====================================================================
+# Lambda lifting
+#
+# A nested procedure whose body, and the bodies of its descendants, only
+# reference temporaries of its own subtree does not need a static link:
+# it becomes a top-level procedure (calls get no link depth), and the
+# temporaries of its subtree are renumbered for their new depth. This
+# holds when the calls of the subtree to procedures outside of it only
+# reach top-level or lifted procedures, hence a greatest fixpoint.
+#
+# A nested procedure without nested procedures whose outer references
+# are only written by their owners (captured parameters, or variables
+# assigned in the owner only) is lifted as well, with the values of
+# these references as extra parameters: the owner is suspended for as
+# long as the procedure runs, so these values cannot change under it.
+# Such a procedure must not escape as a fat pointer, as the callers of
+# a fat pointer do not know about the extra parameters.
+
+class LambdaLifter:
+    MAXARGS = 6                 # parameters passed in registers
+
+    def __init__(
+        self,
+        tac    : list[TACProc | TACVar],
+        report : Opt[Callable[[str], None]] = None,
+    ):
+        self.tac    = tac
+        self.report = report or (lambda _: None)
+        self.lifted = 0
+
+    def _instrs(self, name: str) -> list[TAC]:
+        return [x for x in self.nesting.procs[name].tac if not isinstance(x, str)]
+
+    def _outer(self, name: str, scope: set[str]) -> set[tuple[str, str]]:
+        # references of `name` to temporaries owned outside of `scope`
+        aout = set()
+        for instr in self._instrs(name):
+            for temp in temps_of(instr):
+                owner, base = self.nesting.resolve(name, temp)
+                if owner is not None and owner not in scope:
+                    aout.add((owner, base))
+        return aout
+
+    def _targets(self, name: str) -> set[str]:
+        return {
+            x.arguments[0] for x in self._instrs(name)
+            if x.opcode in ('call', 'fatptr') and x.arguments[0] in self.nesting.procs
+        }
+
+    def _nested(self, name: str) -> bool:
+        return self.nesting.procs[name].parent is not None
+
+    # ----------------------------------------------------------------
+    def _closed(self) -> set[str]:
+        # nested procedures that capture nothing, transitively
+        subtree = { n: { n, *self.nesting.descendants(n) } for n in self.nesting.procs }
+
+        closed = {
+            n for n in self.nesting.procs
+            if self._nested(n) and not any(self._outer(x, subtree[n]) for x in subtree[n])
+        }
+
+        changed = True
+        while changed:
+            changed = False
+            for name in sorted(closed):
+                if any(
+                    self._nested(t) and t not in subtree[name] and t not in closed
+                    for x in subtree[name] for t in self._targets(x)
+                ):
+                    closed.discard(name)
+                    changed = True
+
+        return closed
+
+    def _relink(self, name: str):
+        # the link depths of the calls and fat pointers of a moved body,
+        # from the current depths (fat pointers to top-level procedures
+        # get a link depth of 0)
+        for instr in self.nesting.procs[name].tac:
+            if isinstance(instr, str) or instr.opcode not in ('call', 'fatptr'):
+                continue
+            if instr.arguments[0] in self.nesting.procs:
+                link = self.nesting.link_depth(name, instr.arguments[0])
+                instr.link_depth = 0 if link is None and instr.opcode == 'fatptr' else link
+
+    def _lift(self, closed: set[str]):
+        depths, moved = dict(), set()
+
+        def depth(name):
+            if name not in depths:
+                proc = self.nesting.procs[name]
+                if name in closed or proc.parent is None:
+                    depths[name] = 0
+                else:
+                    depths[name] = depth(proc.parent) + 1
+            return depths[name]
+
+        for name, proc in self.nesting.procs.items():
+            delta = proc.depth - depth(name)
+            if delta != 0:
+                moved.add(name)
+
+            def shift(x):
+                if not is_temp(x) or x.startswith('@'):
+                    return x
+                base, d = split_temp(x)
+                return x if d is None else f'{base}:{d - delta}'
+
+            for instr in proc.tac:
+                if isinstance(instr, str):
+                    continue
+                instr.arguments = [shift(x) for x in instr.arguments]
+                if instr.result is not None:
+                    instr.result = shift(instr.result)
+
+        for name in sorted(closed):
+            proc = self.nesting.procs[name]
+            proc.depth, proc.parent = 0, None
+            self.report(f'lift: {name} lifted')
+            self.lifted += 1
+
+        for name, proc in self.nesting.procs.items():
+            proc.depth = depth(name)
+
+        # the bodies that moved, and the ones that reference a lifted
+        # procedure
+        for name in self.nesting.procs:
+            if name in moved or self._targets(name) & closed:
+                self._relink(name)
+
+    # ----------------------------------------------------------------
+    def _readonly(self) -> dict[str, list[tuple[str, str]]]:
+        # leaf procedures whose outer references are only written by
+        # their owners -> these references
+        writers = dict()
+        for name in self.nesting.procs:
+            for instr in self._instrs(name):
+                if instr.result is not None:
+                    var = self.nesting.resolve(name, instr.result)
+                    writers.setdefault(var, set()).add(name)
+
+        addressed = {
+            x.arguments[0] for n in self.nesting.procs
+            for x in self._instrs(n) if x.opcode == 'fatptr'
+        }
+
+        aout = dict()
+        for name, proc in self.nesting.procs.items():
+            if not self._nested(name) or self.nesting.children[name] or name in addressed:
+                continue
+            refs = sorted(self._outer(name, { name }))
+            if not refs or len(proc.arguments) + len(refs) > self.MAXARGS:
+                continue
+            if any(writers.get(v, set()) - { v[0] } for v in refs):
+                continue
+            if any(self._nested(t) and t != name for t in self._targets(name)):
+                continue
+            aout[name] = refs
+        return aout
+
+    def _lift_with_params(self, name: str, refs: list[tuple[str, str]]):
+        proc   = self.nesting.procs[name]
+        own    = proc.depth + 1
+        extras = { v: MM.fresh_temporary() for v in refs }
+
+        def spell(var):
+            # how `var` is referenced from any procedure that can see it
+            owner, base = var
+            return f'{base}:{self.nesting.procs[owner].depth + 1}'
+
+        def rename(x):
+            if not is_temp(x) or x.startswith('@'):
+                return x
+            var = self.nesting.resolve(name, x)
+            if var in extras:
+                return f'{extras[var]}:1'
+            base, d = split_temp(x)
+            return x if d != own else f'{base}:1'
+
+        # call sites, the recursive ones included
+        for caller in self.nesting.procs.values():
+            aout = []
+            for instr in caller.tac:
+                if not isinstance(instr, str) and instr.opcode == 'call' \
+                        and instr.arguments[0] == name:
+                    count = instr.arguments[1]
+                    for i, var in enumerate(refs):
+                        value = f'{extras[var]}:{own}' if caller is proc else spell(var)
+                        aout.append(TAC('param', [count + i + 1, value]))
+                    instr.arguments[1] = count + len(refs)
+                    instr.link_depth   = None
+                aout.append(instr)
+            caller.tac = aout
+
+        for instr in proc.tac:
+            if isinstance(instr, str):
+                continue
+            instr.arguments = [rename(x) for x in instr.arguments]
+            if instr.result is not None:
+                instr.result = rename(instr.result)
+
+        proc.arguments = proc.arguments + list(extras.values())
+        proc.depth, proc.parent = 0, None
+        self._relink(name)
+
+        self.report(f'lift: {name} lifted with {len(refs)} extra parameter(s)')
+        self.lifted += 1
+
+    # ----------------------------------------------------------------
+    def run(self) -> list[TACProc | TACVar]:
+        self.nesting = Nesting(self.tac)
+        self._lift(self._closed())
+
+        self.nesting = Nesting(self.tac)
+        for name, refs in self._readonly().items():
+            self._lift_with_params(name, refs)
+
+        return self.tac
@@ -4,9 +4,11 @@ import itertools as it
 
 from typing import Optional as Opt
 
-from .bxast   import *
-from .bxscope import Scope
-from .bxtac   import *
+from .bxast    import *
+from .bxerrors import Reporter
+from .bxeval   import Evaluator
+from .bxscope  import Scope
+from .bxtac    import *
 
 # ====================================================================
 # Maximal munch
@@ -20,7 +22,8 @@ class MM:
         Type.BOOL : 'print_bool',
     }
 
-    def __init__(self):
+    def __init__(self, reporter: Reporter):
+        self.reporter = reporter
         self._proc    = [] # changed
         self._tac     = []
         self._scope   = Scope()
@@ -31,9 +34,10 @@ class MM:
     tac = property(lambda self: self._tac)
 
     @staticmethod
-    def mm(prgm: Program):
-        mm = MM(); mm.for_program(prgm)
-        return mm._tac
+    def mm(prgm: Program, reporter: Reporter):
+        with reporter.checkpoint() as checkpoint:
+            mm = MM(reporter); mm.for_program(prgm)
+            return mm._tac if checkpoint else None
 
     @classmethod
     def fresh_temporary(cls):
@@ -71,13 +75,20 @@ class MM:
             self._loops.pop()
 
     def for_program(self, prgm: Program):
+        inits = []
+
         for decl in prgm:
             match decl:
+                case GlobVarDecl(name, IntExpression(value), type_):
+                    self._tac.append(TACVar(name.value, value))
+                    self._scope.push(name.value, f'@{name.value}')
+
                 case GlobVarDecl(name, init, type_):
-                    assert(isinstance(init, IntExpression))
-                    self._tac.append(TACVar(name.value, init.value))
+                    inits.append((TACVar(name.value, None), init))
+                    self._tac.append(inits[-1][0])
                     self._scope.push(name.value, f'@{name.value}')
 
+        # top-level procedures are visible from all the bodies
         for decl in prgm:
             match decl:
                 case ProcDecl(name, arguments, retty, body):
@@ -89,6 +100,9 @@ class MM:
                     # depth for static link calculation
                     self.depths[self._procs[name.value]] = 0
 
+        for decl in prgm:
+            match decl:
+                case ProcDecl(name, arguments, retty, body):
                     with self._scope.in_subscope():
                         with self._procs.in_subscope(): # changed
                             arguments = list(it.chain(*(x[0] for x in arguments)))
@@ -100,7 +114,7 @@ class MM:
                             ))
 
                             for argument in arguments:
-                                self._scope.push(argument.value, f'%{argument.value}')
+                                self._scope.push(argument.value, f'%{argument.value}:{len(self._proc)}')
 
                             self.for_statement(body)
 
@@ -110,6 +124,23 @@ class MM:
                             assert(len(self._proc) != 0)
                             self._tac.append(self._proc.pop()) # put TACProc in tac
 
+        # the other initialisers are evaluated at compile time, as the
+        # body of a procedure that is not emitted
+        evaluator = Evaluator(self._tac)
+
+        for var, init in inits:
+            name = self.fresh_proc_label('init')
+            self.depths[name] = 0
+            self._proc.append(TACProc(depth = 0, name = name, arguments = []))
+            self.for_statement(ReturnStatement(init))
+            evaluator.procs[name] = self._proc.pop()
+            var.value = evaluator.evaluate(name, [])
+            if var.value is None:
+                self.reporter(
+                    'this expression is not a compile-time constant',
+                    position = init.position,
+                )
+
     def for_block(self, block: Block):
         with self._scope.in_subscope():
             with self._procs.in_subscope():
@@ -131,6 +162,7 @@ class MM:
                             depth       = len(self._proc),
                             name        = self._procs[name.value],
                             arguments   = [f'%{x.value}' for x in arguments],
+                            parent      = self._proc[-1].name,
                         ))
 
                         for argument in arguments:
@@ -202,7 +234,12 @@ class MM:
     def for_expression(self, expr: Expression, force = False) -> str:
         target = None
 
-        if not force and expr.type_ == Type.BOOL:
+        # calls already return 0 or 1 for booleans
+        if not force and expr.type_ == Type.BOOL and not isinstance(expr, CallExpression) \
+                and self.is_simple(expr):
+            target = self.for_bvalue(expr)
+
+        elif not force and expr.type_ == Type.BOOL and not isinstance(expr, CallExpression):
             target = self.fresh_temporary()
             tlabel = self.fresh_label()
             flabel = self.fresh_label()
@@ -235,9 +272,16 @@ class MM:
                     target = self.fresh_temporary()
                     self.push('const', value, result = target)
 
+                case OpAppExpression('opposite', [IntExpression(value)]):
+                    target = self.fresh_temporary()
+                    self.push('const', -value, result = target)
+
                 case OpAppExpression(operator, arguments):
                     target    = self.fresh_temporary()
-                    arguments = [self.for_expression(e) for e in arguments]
+                    if OPCODES[operator] in IMMEDIATES:
+                        arguments = [self.for_operand(e) for e in arguments]
+                    else:
+                        arguments = [self.for_expression(e) for e in arguments]
                     self.push(OPCODES[operator], *arguments, result = target)
 
                 case CallExpression(proc, arguments):
@@ -277,13 +321,74 @@ class MM:
 
         return target
 
+    def for_operand(self, expr: Expression) -> str | int:
+        # literals are given as immediates to the instructions that
+        # accept them (see IMMEDIATES)
+        if isinstance(expr, IntExpression) and fits32(expr.value):
+            return expr.value
+        return self.for_expression(expr)
+
+    CMP_SET = {
+        'cmp-equal'                 : 'seteq',
+        'cmp-not-equal'             : 'setne',
+        'cmp-lower-than'            : 'setlt',
+        'cmp-lower-or-equal-than'   : 'setle',
+        'cmp-greater-than'          : 'setgt',
+        'cmp-greater-or-equal-than' : 'setge',
+    }
+
+    @classmethod
+    def is_simple(cls, expr: Expression) -> bool:
+        # expressions that can be evaluated in full, without branching:
+        # no calls, and no division that may trap
+        match expr:
+            case CallExpression() | PrintExpression():
+                return False
+            case OpAppExpression('division' | 'modulus', [e1, e2]):
+                return isinstance(e2, IntExpression) and e2.value != 0 \
+                    and cls.is_simple(e1)
+            case OpAppExpression(_, arguments):
+                return all(cls.is_simple(x) for x in arguments)
+        return True
+
+    def for_bvalue(self, expr: Expression) -> str:
+        # a boolean value (0 or 1) computed with the value forms of the
+        # comparisons and bitwise operations on 0/1
+        match expr:
+            case VarExpression(name):
+                return self._scope[name.value]
+
+            case BoolExpression(value):
+                target = self.fresh_temporary()
+                self.push('const', int(value), result = target)
+                return target
+
+            case OpAppExpression('boolean-and' | 'boolean-or' as op, [e1, e2]):
+                t1, t2 = self.for_bvalue(e1), self.for_bvalue(e2)
+                target = self.fresh_temporary()
+                self.push('and' if op == 'boolean-and' else 'or', t1, t2, result = target)
+                return target
+
+            case OpAppExpression('boolean-not', [e]):
+                t1, target = self.for_bvalue(e), self.fresh_temporary()
+                self.push('xor', t1, 1, result = target)
+                return target
+
+            case OpAppExpression(operator, [e1, e2]) if operator in self.CMP_SET:
+                t1, t2 = self.for_operand(e1), self.for_operand(e2)
+                target = self.fresh_temporary()
+                self.push(self.CMP_SET[operator], t1, t2, result = target)
+                return target
+
+        assert(False)
+
     CMP_JMP = {
-        'cmp-equal'                 : 'jz',
-        'cmp-not-equal'             : 'jnz',
-        'cmp-lower-than'            : 'jgt',
-        'cmp-lower-or-equal-than'   : 'jge',
-        'cmp-greater-than'          : 'jlt',
-        'cmp-greater-or-equal-than' : 'jle',
+        'cmp-equal'                 : 'jeq',
+        'cmp-not-equal'             : 'jne',
+        'cmp-lower-than'            : 'jlt',
+        'cmp-lower-or-equal-than'   : 'jle',
+        'cmp-greater-than'          : 'jgt',
+        'cmp-greater-or-equal-than' : 'jge',
     }
 
     def for_bexpression(self, expr: Expression, tlabel: str, flabel: str):
@@ -310,12 +415,10 @@ class MM:
                     'cmp-greater-or-equal-than',
                     [e1, e2]):
 
-                t1 = self.for_expression(e1)
-                t2 = self.for_expression(e2)
-                t  = self.fresh_temporary()
-                self.push(OPCODES['subtraction'], t2, t1, result = t)
+                t1 = self.for_operand(e1)
+                t2 = self.for_operand(e2)
 
-                self.push(self.CMP_JMP[expr.operator], t, tlabel)
+                self.push(self.CMP_JMP[expr.operator], t1, t2, tlabel)
                 self.push('jmp', flabel)
 
             case OpAppExpression('boolean-and', [e1, e2]):
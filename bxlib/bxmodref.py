@@ -0,0 +1,231 @@
+# --------------------------------------------------------------------
+from typing import Callable, Optional as Opt
+
+from .bxcfg     import *
+from .bxmm      import MM
+from .bxnesting import Nesting
+from .bxtac     import *
+
+# ====================================================================
+# Mod/ref summaries
+#
+# The variables that a call to a procedure may write (mod) or read
+# (ref): the globals and the temporaries of the enclosing frames that
+# the procedure accesses, and the ones of its callees, transitively.
+# Variables are canonical (owner, name) pairs -- the owner is None for
+# globals. The temporaries owned by a procedure belong to the frame
+# that the call creates, and are left out of its summary -- but for the
+# ones that a procedure escaping as a fat pointer accesses: a recursive
+# call may be passed a closure over the frame of its caller. A call
+# through a fat pointer may reach any procedure that escapes as one.
+#
+# A procedure is *pure* when its calls access nothing but their own
+# frames and do not print, transitively: its result only depends on its
+# arguments. It is *total* when it is pure and provably returns: no
+# loop, no recursion, no division that may trap, and total callees.
+
+class ModRef:
+    def __init__(self, nesting: Nesting):
+        self.nesting = nesting
+        self.mod     = { n: set() for n in nesting.procs }
+        self.ref     = { n: set() for n in nesting.procs }
+        self.pure    = set()
+        self.total   = set()
+
+        direct, callees, addressed, printing = dict(), dict(), set(), set()
+
+        for name, proc in nesting.procs.items():
+            mod, ref, targets = set(), set(), set()
+            for instr in proc.tac:
+                if isinstance(instr, str):
+                    continue
+                for temp in instr.arguments:
+                    if is_temp(temp) and self._outer(name, temp):
+                        ref.add(nesting.resolve(name, temp))
+                if instr.result is not None and self._outer(name, instr.result):
+                    mod.add(nesting.resolve(name, instr.result))
+                match instr.opcode:
+                    case 'call' | 'tailcall' if instr.arguments[0] in nesting.procs:
+                        targets.add(instr.arguments[0])
+                    case 'call':
+                        printing.add(name)
+                    case 'callfatptr' | 'tailcallfatptr':
+                        targets.add(None)
+                    case 'fatptr':
+                        addressed.add(instr.arguments[0])
+            direct [name] = (mod, ref)
+            callees[name] = targets
+
+        self.addressed = addressed
+
+        for name, targets in callees.items():
+            if None in targets:
+                callees[name] = (targets - { None }) | addressed
+
+        changed = True
+        while changed:
+            changed = False
+            # accessed through an escaping procedure: maybe in the frame
+            # of another activation of their owner
+            emod = set().union(*(self.mod[x] for x in addressed))
+            eref = set().union(*(self.ref[x] for x in addressed))
+            for name in nesting.procs:
+                mod, ref = map(set, direct[name])
+                for callee in callees[name]:
+                    mod |= self.mod[callee]
+                    ref |= self.ref[callee]
+                mod = { x for x in mod if x[0] != name or x in emod }
+                ref = { x for x in ref if x[0] != name or x in eref }
+                if mod != self.mod[name] or ref != self.ref[name]:
+                    self.mod[name], self.ref[name] = mod, ref
+                    changed = True
+
+        self.escaping = emod
+
+        self._purity(callees, printing)
+
+    def _purity(self, callees: dict[str, set[str]], printing: set[str]):
+        # pure: greatest fixpoint, total: least fixpoint (recursive
+        # procedures are never total) -- a procedure that passes a
+        # closure over its own frame to a call that may run it accesses
+        # that frame from another activation: its summary is not empty
+        pure = {
+            n for n in self.nesting.procs
+            if not self.mod[n] and not self.ref[n] and n not in printing
+        }
+
+        changed = True
+        while changed:
+            changed = False
+            for name in sorted(pure):
+                if not callees[name] <= pure:
+                    pure.discard(name)
+                    changed = True
+
+        bounded = { n for n in pure if self._bounded(self.nesting.procs[n]) }
+        total   = set()
+
+        changed = True
+        while changed:
+            changed = False
+            for name in sorted(bounded - total):
+                if callees[name] <= total:
+                    total.add(name)
+                    changed = True
+
+        self.pure, self.total = pure, total
+
+    def _bounded(self, proc: TACProc) -> bool:
+        # no loop, and no division by a divisor that may be 0 or -1
+        if CFG(proc).loops():
+            return False
+
+        instrs = [x for x in proc.tac if not isinstance(x, str)]
+        consts = { self.nesting.resolve(proc.name, x): None for x in proc.arguments }
+        for instr in instrs:
+            if instr.result is not None:
+                var   = self.nesting.resolve(proc.name, instr.result)
+                value = instr.arguments[0] if instr.opcode == 'const' else None
+                consts[var] = value if var not in consts else None
+
+        for instr in instrs:
+            if instr.opcode in ('div', 'mod'):
+                divisor = instr.arguments[1]
+                if not isinstance(divisor, int):
+                    divisor = consts.get(self.nesting.resolve(proc.name, divisor))
+                if divisor in (None, 0, -1):
+                    return False
+        return True
+
+    def _outer(self, name: str, temp: str) -> bool:
+        return self.nesting.resolve(name, temp)[0] != name
+
+    def writes(self, instr: TAC, caller: str) -> set[tuple[Opt[str], str]]:
+        # variables that a call from `caller` may write (tail calls
+        # leave the frame) -- a new activation of `caller`, or of one of
+        # its ancestors, may be passed closures over the current frame
+        match instr.opcode:
+            case 'call' if instr.arguments[0] in self.mod:
+                callee, name = instr.arguments[0], caller
+                while name is not None and name != callee:
+                    name = self.nesting.procs[name].parent
+                if name is None:
+                    return self.mod[callee]
+                return self.mod[callee] | { x for x in self.escaping if x[0] == caller }
+            case 'callfatptr':
+                return set().union(*(self.mod[x] for x in self.addressed))
+        return set()
+
+# ====================================================================
+# Snapshots of the read-only captured temporaries
+#
+# A temporary of an enclosing frame that neither a procedure nor its
+# callees may write cannot change while the procedure runs (its owner
+# is suspended): it is copied to a private temporary on entry, that is
+# read instead -- from a register, without walking the static chain.
+# This is done when the temporary is read more than once, or in a loop.
+
+class Snapshot:
+    def __init__(
+        self,
+        tac    : list[TACProc | TACVar],
+        report : Opt[Callable[[str], None]] = None,
+    ):
+        self.tac     = tac
+        self.report  = report or (lambda _: None)
+        self.nesting = Nesting(tac)
+        self.modref  = ModRef(self.nesting)
+
+    def _reads(self, proc: TACProc) -> dict[tuple[str, str], int]:
+        # reads of the temporaries of the enclosing frames, weighted by
+        # loop nesting
+        cfg     = CFG(proc)
+        inloops = { id(b) for loop in cfg.loops() for b in loop.blocks }
+        reads   = dict()
+        for block in cfg.blocks:
+            for instr in block.instrs:
+                for temp in instr.arguments:
+                    if not is_temp(temp) or temp.startswith('@'):
+                        continue
+                    var = self.nesting.resolve(proc.name, temp)
+                    if var[0] != proc.name:
+                        reads[var] = reads.get(var, 0) + (10 if id(block) in inloops else 1)
+        return reads
+
+    def _snapshot(self, proc: TACProc) -> int:
+        own   = proc.depth + 1
+        names = dict()
+
+        for var, weight in sorted(self._reads(proc).items()):
+            if weight > 1 and var not in self.modref.mod[proc.name]:
+                names[var] = f'{MM.fresh_temporary()}:{own}'
+
+        if not names:
+            return 0
+
+        def spell(var):
+            owner, base = var
+            return f'{base}:{self.nesting.procs[owner].depth + 1}'
+
+        for instr in proc.tac:
+            if isinstance(instr, str):
+                continue
+            instr.arguments = [
+                names.get(self.nesting.resolve(proc.name, x), x)
+                if is_temp(x) and not x.startswith('@') else x
+                for x in instr.arguments
+            ]
+
+        proc.tac = [TAC('copy', [spell(v)], t) for v, t in names.items()] + proc.tac
+
+        self.report(
+            f'snapshot: {proc.name}: '
+            + ', '.join(f'{base} of {owner}' for owner, base in names)
+        )
+        return len(names)
+
+    def run(self) -> list[TACProc | TACVar]:
+        for proc in self.nesting.procs.values():
+            if proc.parent is not None:
+                self._snapshot(proc)
+        return self.tac
@@ -0,0 +1,97 @@
+# --------------------------------------------------------------------
+from typing import Optional as Opt
+
+from .bxtac import *
+
+# ====================================================================
+# Lexical nesting of procedures and captured temporaries
+#
+# A temporary "%x:d" used in a procedure of depth `p` lives in the
+# frame of the ancestor `p + 1 - d` static links away. A temporary is
+# *captured* when it is owned by a procedure but accessed from one of
+# its descendants: such temporaries can be read or written by calls.
+#
+# The static link of a nested procedure is kept in the first slot of
+# its frame (`LINK`), so that the chain can be walked from any frame.
+
+class Nesting:
+    RUNTIME = ('print_int', 'print_bool')
+    LINK    = '.link'
+
+    def __init__(self, tac: list[TACProc | TACVar]):
+        self.procs    = dict()
+        self.children = dict()
+        self.captured = dict()
+        self.globals  = set()
+
+        for decl in tac:
+            match decl:
+                case TACVar(name, _):
+                    self.globals.add(f'@{name}')
+
+                case TACProc():
+                    self.procs   [decl.name] = decl
+                    self.children[decl.name] = []
+                    self.captured[decl.name] = set()
+
+        for proc in self.procs.values():
+            if proc.parent is not None:
+                self.children[proc.parent].append(proc.name)
+
+        for proc in self.procs.values():
+            for instr in proc.tac:
+                if isinstance(instr, str):
+                    continue
+                for temp in temps_of(instr):
+                    owner, base = self.resolve(proc.name, temp)
+                    if owner is not None and owner != proc.name:
+                        self.captured[owner].add(base)
+
+    def ancestor(self, name: str, distance: int) -> str:
+        for _ in range(distance):
+            name = self.procs[name].parent
+            assert(name is not None)
+        return name
+
+    def descendants(self, name: str) -> list[str]:
+        aout = []
+        for child in self.children[name]:
+            aout.append(child)
+            aout.extend(self.descendants(child))
+        return aout
+
+    def distance(self, name: str, temp: str) -> Opt[int]:
+        # number of static links to follow to reach the temporary frame
+        # (None for globals)
+        if temp.startswith('@'):
+            return None
+        _, depth = split_temp(temp)
+        if depth is None:
+            return 0
+        return self.procs[name].depth + 1 - depth
+
+    def link_depth(self, caller: str, callee: str) -> Opt[int]:
+        # static links to follow from `caller` to reach the parent of
+        # `callee` (None for top-level callees)
+        if callee not in self.procs or self.procs[callee].parent is None:
+            return None
+        return self.procs[caller].depth - self.procs[callee].depth + 1
+
+    def resolve(self, name: str, temp: str) -> tuple[Opt[str], str]:
+        # (owning procedure, unsuffixed name) -- owner is None for globals
+        if temp.startswith('@'):
+            return None, temp
+        base, _ = split_temp(temp)
+        return self.ancestor(name, self.distance(name, temp)), base
+
+    def frame(self, name: str) -> dict[str, int]:
+        # the static link and the captured temporaries get the first
+        # slots of their owner frame, in an order that descendants can
+        # recompute
+        fixed = [self.LINK] if self.procs[name].parent is not None else []
+        return { x: i for i, x in enumerate(fixed + sorted(self.captured[name])) }
+
+    def is_private(self, name: str, temp: str) -> bool:
+        # private temporaries cannot be observed from any other frame
+        owner, base = self.resolve(name, temp)
+        return owner == name and base not in self.captured[name]
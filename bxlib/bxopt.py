@@ -0,0 +1,1084 @@
+# --------------------------------------------------------------------
+from typing import Callable, Optional as Opt
+
+from .bxcfg     import *
+from .bxeval    import CallFolder
+from .bxinline  import Inliner
+from .bxlift    import LambdaLifter
+from .bxmm      import MM
+from .bxmodref  import ModRef, Snapshot
+from .bxnesting import Nesting
+from .bxspec    import Specializer
+from .bxtac     import *
+
+# ====================================================================
+# TAC optimiser
+
+PURE        = ('const', 'copy', 'neg', 'not', 'add', 'sub', 'mul',
+               'and', 'or', 'xor', 'shl', 'shr',
+               'seteq', 'setne', 'setlt', 'setle', 'setgt', 'setge')
+TRAPPING    = ('div', 'mod')
+CALLS       = ('call', 'callfatptr', 'tailcall', 'tailcallfatptr')
+COMMUTATIVE = ('add', 'mul', 'and', 'or', 'xor', 'seteq', 'setne')
+
+# --------------------------------------------------------------------
+class ProcContext:
+    """A procedure under optimisation, together with the facts about
+    its temporaries that are derived from the lexical nesting."""
+
+    def __init__(self, proc: TACProc, nesting: Nesting, modref: ModRef):
+        self.proc    = proc
+        self.nesting = nesting
+        self.modref  = modref
+        self.cfg     = CFG(proc)
+
+    def var(self, temp: str) -> tuple[Opt[str], str]:
+        # canonical name: the same variable may be spelled "%x" or "%x:d"
+        return self.nesting.resolve(self.proc.name, temp)
+
+    def is_private(self, temp: str) -> bool:
+        return self.nesting.is_private(self.proc.name, temp)
+
+    def clobbers(self, instr: TAC, var: tuple[Opt[str], str]) -> bool:
+        # calls may write globals and captured temporaries, either
+        # directly (nested callees write through their static link) or
+        # through a fat pointer that escaped in a previous call: the
+        # mod/ref summaries tell which ones
+        match instr.opcode:
+            case 'call' | 'callfatptr':
+                return var in self.modref.writes(instr, self.proc.name)
+            case 'tailcall' | 'tailcallfatptr':
+                return True
+        return False
+
+    def shared(self) -> set[tuple[Opt[str], str]]:
+        aout = set()
+        for block in self.cfg.blocks:
+            for instr in block.instrs:
+                for temp in temps_of(instr):
+                    if not self.is_private(temp):
+                        aout.add(self.var(temp))
+        return aout
+
+    def liveness(self) -> dict[int, set]:
+        # live-out canonical variables, per block
+        liveout = { id(b): set() for b in self.cfg.blocks }
+
+        def transfer(block, live):
+            live = set(live)
+            for instr in block.instrs[::-1]:
+                if instr.result is not None:
+                    live.discard(self.var(instr.result))
+                live.update(self.var(x) for x in instr.arguments if is_temp(x))
+            return live
+
+        changed = True
+        while changed:
+            changed = False
+            for block in self.cfg.rpo()[::-1]:
+                out = set()
+                for succ in block.succs:
+                    out |= transfer(succ, liveout[id(succ)])
+                if out != liveout[id(block)]:
+                    liveout[id(block)] = out
+                    changed = True
+        return liveout
+
+    def livein(self, block: BasicBlock, liveout: dict[int, set]) -> set:
+        live = set(liveout[id(block)])
+        for instr in block.instrs[::-1]:
+            if instr.result is not None:
+                live.discard(self.var(instr.result))
+            live.update(self.var(x) for x in instr.arguments if is_temp(x))
+        return live
+
+    def definitions(self, temp: str) -> list[TAC]:
+        var = self.var(temp)
+        return [
+            x for b in self.cfg.blocks for x in b.instrs
+            if x.result is not None and self.var(x.result) == var
+        ]
+
+    def constant(self, temp: str | int) -> Opt[int]:
+        # value of an immediate, or of a private temporary whose only
+        # definition is a constant, possibly through a chain of copies
+        if isinstance(temp, int):
+            return temp
+        seen = set()
+        while is_temp(temp) and self.is_private(temp) and self.var(temp) not in seen:
+            seen.add(self.var(temp))
+            defs = self.definitions(temp)
+            if len(defs) != 1:
+                return None
+            match defs[0].opcode:
+                case 'const':
+                    return defs[0].arguments[0]
+                case 'copy':
+                    temp = defs[0].arguments[0]
+                case _:
+                    return None
+        return None
+
+    def closure(self, temp: str) -> Opt[TAC]:
+        # the `fatptr` that defines a private temporary, possibly
+        # through a chain of copies
+        seen = set()
+        while is_temp(temp) and self.is_private(temp) and self.var(temp) not in seen:
+            seen.add(self.var(temp))
+            if split_temp(temp)[0] in self.proc.arguments:
+                return None
+            defs = self.definitions(temp)
+            if len(defs) != 1:
+                return None
+            match defs[0].opcode:
+                case 'fatptr':
+                    return defs[0]
+                case 'copy':
+                    temp = defs[0].arguments[0]
+                case _:
+                    return None
+        return None
+
+    def params(self, block: BasicBlock, index: int, count: int) -> Opt[list[tuple]]:
+        # the `param` instructions of the call at block.instrs[index],
+        # with their blocks, in layout order
+        aout   = []
+        blocks = self.cfg.blocks
+        bindex = next(i for i, b in enumerate(blocks) if b is block)
+
+        for b in blocks[bindex::-1]:
+            instrs = b.instrs[:index] if b is block else b.instrs
+            for instr in instrs[::-1]:
+                if len(aout) == count:
+                    break
+                if instr.opcode in ('call', 'callfatptr'):
+                    return None
+                if instr.opcode == 'param':
+                    aout.append((b, instr))
+
+        if len(aout) != count:
+            return None
+        return aout[::-1]
+
+    def commit(self):
+        self.proc.tac = self.cfg.tolist()
+
+# --------------------------------------------------------------------
+class Devirtualize:
+    """Turns the calls through a fat pointer built in the same frame
+    into direct calls (the static link of the record is the one a
+    direct call from this frame computes)."""
+
+    def __init__(self, ctx: ProcContext):
+        self.ctx     = ctx
+        self.changes = 0
+
+    def run(self) -> int:
+        for block in self.ctx.cfg.blocks:
+            for instr in block.instrs:
+                if instr.opcode != 'callfatptr':
+                    continue
+                closure = self.ctx.closure(instr.arguments[0])
+                if closure is None:
+                    continue
+                callee = closure.arguments[0]
+                instr.opcode     = 'call'
+                instr.arguments  = [callee, instr.arguments[1]]
+                instr.link_depth = self.ctx.nesting.link_depth(self.ctx.proc.name, callee)
+                self.changes += 1
+        return self.changes
+
+# --------------------------------------------------------------------
+class TailCalls:
+    """Tail-call elimination.
+
+    A call directly followed by the return of its result is replaced,
+    when the callee is the procedure itself, by the assignment of the
+    arguments and a jump back to the entry: the static link is the same
+    for a self call. Other tail calls become `tailcall` (resp.
+    `tailcallfatptr`), that the back end lowers to a jump reusing the
+    frame of the caller. This requires that nothing may refer to the
+    current frame after the jump (no nested callee, no fat pointer built
+    here), and that all the arguments are passed in registers."""
+
+    MAXARGS = 6
+
+    def __init__(self, ctx: ProcContext):
+        self.ctx     = ctx
+        self.cfg     = ctx.cfg
+        self.proc    = ctx.proc
+        self.entry   = None
+        self.changes = 0
+
+    def _returns(self, block: BasicBlock, index: int, call: TAC) -> bool:
+        rest, seen = block.instrs[index+1:], set()
+        while not rest:
+            if not block.succs:
+                return True
+            if id(block) in seen:
+                return False
+            seen.add(id(block))
+            block = block.succs[0]
+            rest  = block.instrs
+        return len(rest) == 1 and rest[0].opcode == 'ret' \
+            and rest[0].arguments in ([], [call.result])
+
+    def _entry(self) -> str:
+        if self.entry is None:
+            first = self.cfg.blocks[0]
+            self.entry = self.cfg.label(first)
+            self.cfg.blocks.insert(0, BasicBlock(None))
+            self.cfg.relink()
+        return self.entry
+
+    def _self(self, block: BasicBlock, index: int, call: TAC) -> bool:
+        params = self.ctx.params(block, index, call.arguments[1])
+        if params is None:
+            return False
+
+        moves, temps = [], []
+        for _, param in params:
+            temps.append(MM.fresh_temporary())
+            moves.append(TAC('copy', [param.arguments[1]], temps[-1]))
+        for argument, temp in zip(self.proc.arguments, temps):
+            moves.append(TAC('copy', [temp], f'{argument}:{self.proc.depth+1}'))
+
+        for b, param in params:
+            b.instrs = [x for x in b.instrs if x is not param]
+        index = next(i for i, x in enumerate(block.instrs) if x is call)
+
+        block.instrs[index:] = moves + [TAC('jmp', [self._entry()])]
+        return True
+
+    def run(self) -> int:
+        local = self.proc.name == 'main' or any(
+            x.opcode == 'fatptr' for b in self.cfg.blocks for x in b.instrs
+        )
+
+        for block in list(self.cfg.blocks):
+            for index, instr in enumerate(block.instrs):
+                if instr.opcode not in ('call', 'callfatptr'):
+                    continue
+                if not self._returns(block, index, instr):
+                    continue
+
+                if instr.opcode == 'call' and instr.arguments[0] == self.proc.name:
+                    if local or not self._self(block, index, instr):
+                        continue
+
+                elif instr.opcode == 'call':
+                    if local or instr.arguments[0] in Nesting.RUNTIME:
+                        continue
+                    if instr.arguments[1] > self.MAXARGS or instr.link_depth == 0:
+                        continue
+                    block.instrs[index:] = [
+                        TAC('tailcall', instr.arguments[:], None, instr.link_depth)
+                    ]
+
+                else:
+                    if local or instr.arguments[1] > self.MAXARGS:
+                        continue
+                    block.instrs[index:] = [TAC('tailcallfatptr', instr.arguments[:])]
+
+                self.changes += 1
+                break
+
+        self.cfg.relink()
+        return self.changes
+
+# --------------------------------------------------------------------
+class GVN:
+    """Dominator-based global value numbering.
+
+    Values are named after the definition that produced them. The
+    value of an operand is known only when a single definition reaches
+    it and that definition dominates the use, which is the property
+    SSA form would give us: any dominating computation of the same
+    expression then holds the same value. Calls are definitions of the
+    non-private temporaries they may write (see `ProcContext.clobbers`).
+    A fat pointer is a value as well: the static chain of a frame does
+    not change, so a record built for the same procedure and link depth
+    holds the same closure, and so is the result of a call to a pure
+    procedure (see `ModRef`) with the same arguments -- a redundant call
+    is removed together with its `param` instructions."""
+
+    ENTRY = (-1, -1)
+
+    def __init__(self, ctx: ProcContext):
+        self.ctx     = ctx
+        self.shared  = ctx.shared()
+        self.removed = 0
+
+    def _defs(self, instr: TAC, pos: tuple) -> list:
+        # (variable, definition) pairs -- a clobbered variable gets a
+        # definition of its own, distinct from the call result
+        aout = []
+        if instr.opcode in CALLS:
+            aout.extend(
+                (var, pos + (var,)) for var in self.shared if self.ctx.clobbers(instr, var)
+            )
+        if instr.result is not None:
+            aout.append((self.ctx.var(instr.result), pos))
+        return aout
+
+    def _reaching(self, order: list[BasicBlock]) -> dict:
+        allvars = set()
+        for block in order:
+            for instr in block.instrs:
+                allvars.update(self.ctx.var(x) for x in temps_of(instr))
+
+        ins, outs = dict(), dict()
+
+        changed = True
+        while changed:
+            changed = False
+            for block in order:
+                if block is self.ctx.cfg.entry:
+                    state = { x: frozenset([self.ENTRY]) for x in allvars }
+                else:
+                    state = dict()
+                    for pred in block.preds:
+                        for var, defs in outs.get(id(pred), dict()).items():
+                            state[var] = state.get(var, frozenset()) | defs
+                ins[id(block)] = dict(state)
+                for i, instr in enumerate(block.instrs):
+                    for var, d in self._defs(instr, (id(block), i)):
+                        state[var] = frozenset([d])
+                if outs.get(id(block)) != state:
+                    outs[id(block)] = state
+                    changed = True
+
+        return ins
+
+    def run(self) -> int:
+        cfg   = self.ctx.cfg
+        order = cfg.rpo()
+        ins   = self._reaching(order)
+        bymap = { id(b): b for b in order }
+
+        self.values = dict()        # definition -> value
+        self.table  = dict()        # expression key -> [(definition, value)]
+        self.holder = dict()        # value -> (definition, instruction)
+        self.splits = dict()        # id(instruction) -> fresh temporary
+        self.insert = dict()        # id(instruction) -> [instructions]
+        self.drop   = set()         # id(instruction) of removed parameters
+
+        def dominates(p1, p2):
+            if p1[0] == p2[0]:
+                return p1[1] < p2[1]
+            return cfg.dominates(bymap[p1[0]], bymap[p2[0]])
+
+        for block in order:
+            state = dict(ins[id(block)])
+
+            def reaching(temp):
+                return state.get(self.ctx.var(temp), frozenset())
+
+            def value(temp, pos):
+                defs = reaching(temp)
+                if len(defs) == 1:
+                    (d,) = defs
+                    if d == self.ENTRY:
+                        return ('entry', self.ctx.var(temp))
+                    if dominates(d, pos):
+                        return self.values.get(d, ('def', d))
+                return ('opaque', pos, temp)
+
+            def holds(temp, d):
+                return reaching(temp) == frozenset([d])
+
+            for i, instr in enumerate(block.instrs):
+                pos = (id(block), i)
+
+                # copy propagation: read private values from their leader,
+                # and known constants as immediates where allowed
+                for j, arg in enumerate(instr.arguments):
+                    if not is_temp(arg):
+                        continue
+                    v = value(arg, pos)
+                    if instr.opcode in IMMEDIATES and self._constant(v) is not None:
+                        instr.arguments[j] = self._constant(v)
+                        continue
+                    leader = self._leader(v, holds)
+                    if leader is not None and leader != arg:
+                        instr.arguments[j] = leader
+
+                if instr.result is not None:
+                    if instr.opcode == 'copy':
+                        self.values[pos] = value(instr.arguments[0], pos)
+
+                    elif (key := self._key(block, i, instr, value)) is not None:
+                        for hpos, v in self.table.get(key, []):
+                            if dominates(hpos, pos):
+                                self.values[pos] = v
+                                if instr.opcode == 'call':
+                                    params = self.ctx.params(block, i, instr.arguments[1])
+                                    self.drop |= { id(x) for _, x in params }
+                                    instr.link_depth = None
+                                self._replace(instr, v, holds)
+                                break
+                        else:
+                            self.values[pos] = ('def', pos)
+                            self.table.setdefault(key, []).append((pos, self.values[pos]))
+                            self.holder[self.values[pos]] = (pos, instr)
+
+                    else:
+                        self.values[pos] = ('def', pos)
+                        self.holder[self.values[pos]] = (pos, instr)
+
+                for var, d in self._defs(instr, pos):
+                    state[var] = frozenset([d])
+
+        for block in order:
+            if not any(id(x) in self.insert or id(x) in self.drop for x in block.instrs):
+                continue
+            instrs = []
+            for instr in block.instrs:
+                if id(instr) not in self.drop:
+                    instrs.append(instr)
+                instrs.extend(self.insert.get(id(instr), []))
+            block.instrs = instrs
+
+        return self.removed
+
+    def _key(self, block: BasicBlock, index: int, instr: TAC, value) -> Opt[tuple]:
+        # the expression computed by `instr`, in terms of values
+        pos = (id(block), index)
+        key = [instr.opcode]
+
+        match instr.opcode:
+            case 'const':
+                key.append(instr.arguments[0])
+            case 'fatptr':
+                key.extend([instr.arguments[0], instr.link_depth])
+            case 'call' if instr.arguments[0] in self.ctx.modref.pure:
+                params = self.ctx.params(block, index, instr.arguments[1])
+                if params is None:
+                    return None
+                key.append(instr.arguments[0])
+                key.extend(
+                    value(x.arguments[1], pos) if is_temp(x.arguments[1]) else ('imm', x.arguments[1])
+                    for _, x in params
+                )
+            case _ if instr.opcode in PURE + TRAPPING:
+                key.extend(
+                    value(x, pos) if is_temp(x) else ('imm', x)
+                    for x in instr.arguments
+                )
+            case _:
+                return None
+
+        if instr.opcode in COMMUTATIVE:
+            key[1:] = sorted(key[1:], key = repr)
+        return tuple(key)
+
+    def _constant(self, v) -> Opt[int]:
+        # the value of a `const` that fits in an immediate
+        if v in self.holder:
+            _, hinstr = self.holder[v]
+            if hinstr.opcode == 'const' and fits32(hinstr.arguments[0]):
+                return hinstr.arguments[0]
+        return None
+
+    def _leader(self, v, holds) -> Opt[str]:
+        # a private temporary that currently holds the value `v`
+        if v not in self.holder:
+            return None
+        hpos, hinstr = self.holder[v]
+        if id(hinstr) in self.splits:
+            return self.splits[id(hinstr)]
+        if self.ctx.is_private(hinstr.result) and holds(hinstr.result, hpos):
+            return hinstr.result
+        return None
+
+    def _replace(self, instr: TAC, v, holds):
+        source = self._leader(v, holds)
+
+        if source is None:
+            # the holder result is overwritten (or observable from other
+            # frames): compute the value into a fresh temporary instead
+            _, hinstr = self.holder[v]
+            source = MM.fresh_temporary()
+            self.insert[id(hinstr)] = [TAC('copy', [source], hinstr.result)]
+            self.splits[id(hinstr)] = source
+            hinstr.result = source
+
+        instr.opcode    = 'copy'
+        instr.arguments = [source]
+        self.removed   += 1
+
+# --------------------------------------------------------------------
+class DCE:
+    """Removes the side-effect free instructions whose result is a
+    private temporary that is never read, and the calls to total
+    procedures (see `ModRef`) whose result is not read, together with
+    their `param` instructions."""
+
+    def __init__(self, ctx: ProcContext):
+        self.ctx = ctx
+
+    def _call(self, block: BasicBlock, index: int, instr: TAC, live: set) -> Opt[list]:
+        # the `param` instructions of a dead call to a total procedure
+        if instr.opcode != 'call' or instr.arguments[0] not in self.ctx.modref.total:
+            return None
+        if instr.result is not None:
+            if self.ctx.var(instr.result) in live or not self.ctx.is_private(instr.result):
+                return None
+        return self.ctx.params(block, index, instr.arguments[1])
+
+    def run(self) -> int:
+        removed = 0
+
+        while True:
+            liveout = self.ctx.liveness()
+            count   = 0
+            drop    = set()
+
+            for block in self.ctx.cfg.blocks:
+                live, kept = set(liveout[id(block)]), []
+
+                for index in range(len(block.instrs) - 1, -1, -1):
+                    instr = block.instrs[index]
+                    if id(instr) in drop:
+                        continue
+                    params = self._call(block, index, instr, live)
+                    if params is not None:
+                        drop |= { id(x) for _, x in params }
+                        count += 1
+                        continue
+                    if instr.result is not None and instr.opcode in PURE + ('fatptr',):
+                        var = self.ctx.var(instr.result)
+                        dead = var not in live and self.ctx.is_private(instr.result)
+                        nop  = instr.opcode == 'copy' and \
+                            self.ctx.var(instr.arguments[0]) == var
+                        if dead or nop:
+                            count += 1
+                            continue
+                    if instr.result is not None:
+                        live.discard(self.ctx.var(instr.result))
+                    live.update(self.ctx.var(x) for x in instr.arguments if is_temp(x))
+                    kept.append(instr)
+
+                block.instrs = kept[::-1]
+
+            for block in self.ctx.cfg.blocks:
+                block.instrs = [x for x in block.instrs if id(x) not in drop]
+
+            removed += count
+            if count == 0:
+                return removed
+
+# --------------------------------------------------------------------
+class LICM:
+    """Loop-invariant code motion, innermost loops first.
+
+    An instruction is hoisted to the loop preheader when its operands
+    are not written in the loop and its result is a private temporary
+    written only there and not read before it. A call in the loop
+    counts as a write of the non-private temporaries it may write,
+    since nested procedures may update outer variables through static
+    links (see `ProcContext.clobbers`). A `div`/`mod` is only hoisted
+    when it cannot trap (constant divisor other than 0 and -1) or when
+    it would run, without any call before it, on each entry to the
+    loop."""
+
+    HOISTABLE = PURE + TRAPPING + ('fatptr',)
+
+    def __init__(self, ctx: ProcContext):
+        self.ctx     = ctx
+        self.cfg     = ctx.cfg
+        self.shared  = ctx.shared()
+        self.hoisted = 0
+
+    def _hoist(self, loop: Loop):
+        ctx  = self.ctx
+        defs = dict()
+
+        for block in loop.blocks:
+            for instr in block.instrs:
+                if instr.opcode in CALLS:
+                    for var in self.shared:
+                        if ctx.clobbers(instr, var):
+                            defs[var] = defs.get(var, 0) + 2
+                if instr.result is not None:
+                    var = ctx.var(instr.result)
+                    defs[var] = defs.get(var, 0) + 1
+
+        liveout = ctx.liveness()
+        inhead  = ctx.livein(loop.header, liveout)
+        exiting = [b for b in loop.blocks if any(s not in loop for s in b.succs)]
+        atexit  = set()
+        for block in loop.exits():
+            atexit |= ctx.livein(block, liveout)
+
+        invariant, marked, hoisted = set(), set(), []
+
+        def hoistable(block, index, instr):
+            if instr.result is None or instr.opcode not in self.HOISTABLE:
+                return False
+
+            var = ctx.var(instr.result)
+            if not ctx.is_private(instr.result) or defs.get(var) != 1 or var in inhead:
+                return False
+            if var in atexit and not all(self.cfg.dominates(block, x) for x in exiting):
+                return False
+
+            for arg in instr.arguments:
+                if is_temp(arg) and ctx.var(arg) in defs and ctx.var(arg) not in invariant:
+                    return False
+
+            if instr.opcode in TRAPPING:
+                if ctx.constant(instr.arguments[1]) not in (None, 0, -1):
+                    return True
+                return block is loop.header and not any(
+                    x.opcode in ('call', 'callfatptr') for x in block.instrs[:index]
+                )
+
+            return True
+
+        order   = [b for b in self.cfg.rpo() if b in loop]
+        changed = True
+        while changed:
+            changed = False
+            for block in order:
+                for index, instr in enumerate(block.instrs):
+                    if id(instr) not in marked and hoistable(block, index, instr):
+                        marked.add(id(instr))
+                        hoisted.append(instr)
+                        invariant.add(ctx.var(instr.result))
+                        changed = True
+
+        if not hoisted:
+            return
+
+        pre = self.cfg.preheader(loop)
+        for block in loop.blocks:
+            block.instrs = [x for x in block.instrs if id(x) not in marked]
+        pre.instrs.extend(hoisted)
+        self.hoisted += len(hoisted)
+
+    def run(self) -> int:
+        for loop in self.cfg.walkloops():
+            self._hoist(loop)
+        return self.hoisted
+
+# --------------------------------------------------------------------
+class InductionVariables:
+    """Induction-variable strength reduction, innermost loops first.
+
+    A basic induction variable `i` is a private temporary whose only
+    definition in the loop adds an invariant step to itself. Each
+    product `i * k` (or `i << s`) by an invariant is replaced by a
+    temporary that is initialised in the preheader and bumped right
+    after the update of `i`; this is exact under wrapping arithmetic.
+
+    When `i` is then only read by the exit test of the header, the
+    test is rewritten against the product (linear-function test
+    replacement) and the update of `i` is removed. This requires
+    constant bounds that show that no product overflows."""
+
+    def __init__(self, ctx: ProcContext):
+        self.ctx     = ctx
+        self.cfg     = ctx.cfg
+        self.reduced = 0
+
+    def _update(self, var, site, defs, invariant):
+        # (sign, step, instructions) when `site` is `i = i +/- c`,
+        # possibly split as `t = i +/- c; i = copy t`
+        block, index, instr = site
+        chain = [instr]
+
+        if instr.opcode == 'copy':
+            source = instr.arguments[0]
+            sdefs  = defs.get(self.ctx.var(source), [])
+            if not self.ctx.is_private(source) or len(sdefs) != 1:
+                return None
+            sblock, sindex, instr = sdefs[0]
+            if sblock is not block or sindex > index:
+                return None
+            chain.insert(0, instr)
+
+        def same(arg):
+            return is_temp(arg) and self.ctx.var(arg) == var
+
+        x, y = instr.arguments if len(instr.arguments) == 2 else (None, None)
+        match instr.opcode:
+            case 'add' if same(x) and invariant(y):
+                return +1, y, chain
+            case 'add' if same(y) and invariant(x):
+                return +1, x, chain
+            case 'sub' if same(x) and invariant(y):
+                return -1, y, chain
+        return None
+
+    def _entry(self, pre: BasicBlock, var) -> Opt[int]:
+        # constant value of `var` when entering the loop, looking back
+        # along the chain of single predecessors of the preheader
+        block, seen = pre, set()
+        while id(block) not in seen:
+            seen.add(id(block))
+            for instr in block.instrs[::-1]:
+                if instr.result is not None and self.ctx.var(instr.result) == var:
+                    match instr.opcode:
+                        case 'const':
+                            return instr.arguments[0]
+                        case 'copy':
+                            return self.ctx.constant(instr.arguments[0])
+                    return None
+            if len(block.preds) != 1:
+                return None
+            block = block.preds[0]
+        return None
+
+    def _reduce(self, loop: Loop):
+        ctx  = self.ctx
+        defs = dict()
+
+        shared    = ctx.shared()
+        clobbered = set()
+        for block in loop.blocks:
+            for index, instr in enumerate(block.instrs):
+                if instr.opcode in CALLS:
+                    clobbered |= { v for v in shared if ctx.clobbers(instr, v) }
+                if instr.result is not None:
+                    defs.setdefault(ctx.var(instr.result), []).append((block, index, instr))
+
+        def invariant(arg):
+            if isinstance(arg, int):
+                return True
+            if not is_temp(arg):
+                return False
+            return ctx.var(arg) not in defs and ctx.var(arg) not in clobbered
+
+        basics = dict()
+        for var, sites in defs.items():
+            if len(sites) == 1 and ctx.is_private(sites[0][2].result):
+                update = self._update(var, sites[0], defs, invariant)
+                if update is not None:
+                    basics[var] = (sites[0][2].result,) + update
+
+        def var(arg):
+            return ctx.var(arg) if is_temp(arg) else None
+
+        # products of a basic induction variable by an invariant
+        groups = dict()
+        for block in loop.blocks:
+            for instr in block.instrs:
+                if instr.opcode not in ('mul', 'shl'):
+                    continue
+                x, y = instr.arguments
+                if instr.opcode == 'mul' and var(y) in basics and invariant(x):
+                    x, y = y, x
+                if var(x) not in basics or var(x) == var(y):
+                    continue
+                if instr.opcode == 'shl':
+                    shift = ctx.constant(y)
+                    if shift is None or not 0 <= shift < 63:
+                        continue
+                    key = (ctx.var(x), 1 << shift)
+                elif not invariant(y):
+                    continue
+                elif ctx.constant(y) is not None:
+                    key = (ctx.var(x), ctx.constant(y))
+                else:
+                    key = (ctx.var(x), y)
+                groups.setdefault(key, []).append(instr)
+
+        if not groups:
+            return
+
+        pre   = self.cfg.preheader(loop)
+        after = dict()
+        temps = dict()
+
+        for (var, factor), products in groups.items():
+            temp, sign, step, chain = basics[var]
+            reduced = MM.fresh_temporary()
+
+            if isinstance(factor, int):
+                ktemp = MM.fresh_temporary()
+                pre.instrs.append(TAC('const', [factor], ktemp))
+            else:
+                ktemp = factor
+            pre.instrs.append(TAC('mul', [temp, ktemp], reduced))
+
+            stemp = MM.fresh_temporary()
+            cstep = ctx.constant(step)
+            if isinstance(factor, int) and cstep is not None \
+                    and fits32(sign * cstep * factor):
+                pre.instrs.append(TAC('const', [sign * cstep * factor], stemp))
+            elif sign > 0:
+                pre.instrs.append(TAC('mul', [step, ktemp], stemp))
+            else:
+                negated = MM.fresh_temporary()
+                pre.instrs.append(TAC('mul', [step, ktemp], negated))
+                pre.instrs.append(TAC('neg', [negated], stemp))
+
+            after.setdefault(id(chain[-1]), []).append(
+                TAC('add', [reduced, stemp], reduced)
+            )
+            for instr in products:
+                instr.opcode    = 'copy'
+                instr.arguments = [reduced]
+            temps.setdefault(var, []).append((factor, reduced))
+            self.reduced += len(products)
+
+        for block in loop.blocks:
+            instrs = []
+            for instr in block.instrs:
+                instrs.append(instr)
+                instrs.extend(after.get(id(instr), []))
+            block.instrs = instrs
+
+        for var, reduced in temps.items():
+            self._replace_test(loop, pre, var, basics[var], reduced)
+
+    def _replace_test(self, loop, pre, var, basic, reduced):
+        ctx = self.ctx
+        temp, sign, step, chain = basic
+
+        header = loop.header
+        term   = header.terminator
+        if term is None or term.opcode not in ('jlt', 'jle', 'jgt', 'jge'):
+            return
+
+        # the exit test `jcc i, n` or `jcc n, i`
+        x, y = term.arguments[:2]
+        if is_temp(x) and ctx.var(x) == var:
+            index, flip = 0, False
+        elif is_temp(y) and ctx.var(y) == var:
+            index, flip = 1, True
+        else:
+            return
+
+        bound = ctx.constant(term.arguments[1-index])
+        start = self._entry(pre, var)
+        cstep = ctx.constant(step)
+        if bound is None or start is None or cstep is None:
+            return
+        cstep *= sign
+
+        # relation between `i` and `n` that keeps the loop running; the
+        # variable must move towards the exit, by at most one step per
+        # iteration
+        target = ctx.cfg.block(term.arguments[-1])
+        if target in loop:
+            relation = term.opcode
+        else:
+            relation = INVERSE[term.opcode]
+        if flip:
+            relation = SWAPPED[relation]
+        if (cstep > 0) != (relation in ('jlt', 'jle')) or cstep == 0:
+            return
+
+        ublock = next(b for b in loop.blocks if any(x is chain[-1] for x in b.instrs))
+        for inner in self.cfg.loops():
+            if inner.header is not header and ublock in inner and inner.header in loop:
+                return
+
+        factor, product = next(((k, t) for k, t in reduced if isinstance(k, int) and k > 0), (None, None))
+        if factor is None:
+            return
+        lo = min(start, bound) - abs(cstep)
+        hi = max(start, bound) + abs(cstep)
+        if not (fits32(lo * factor) and fits32(hi * factor)):
+            return
+
+        # in the loop, the variable may only be read by its own update
+        # and the test, and it must be dead after the loop
+        def readers(v, blocks):
+            return [
+                x for b in blocks for x in b.instrs
+                if any(ctx.var(a) == v for a in x.arguments if is_temp(a))
+            ]
+
+        if any(all(x is not y for y in chain + [term]) for x in readers(var, loop.blocks)):
+            return
+        if len(chain) == 2 and len(readers(ctx.var(chain[0].result), self.cfg.blocks)) != 1:
+            return
+        liveout = ctx.liveness()
+        if any(var in ctx.livein(b, liveout) for b in loop.exits()):
+            return
+
+        term.arguments[index]   = product
+        term.arguments[1-index] = bound * factor
+
+        for block in loop.blocks:
+            block.instrs = [x for x in block.instrs if not any(x is y for y in chain)]
+
+    def run(self) -> int:
+        for loop in self.cfg.walkloops():
+            self._reduce(loop)
+        return self.reduced
+
+# --------------------------------------------------------------------
+class BranchSimplify:
+    """Jump threading and branch layout clean-up.
+
+    - jumps to jumps (or to empty blocks) are retargeted to their final
+      destination, and jumps to a lone `ret` become that `ret`;
+    - "jcc L1; jmp L2; L1:" becomes "jncc L2; L1:";
+    - jumps to the next block are removed;
+    - loops are rotated: the back edge gets its own copy of a small
+      loop condition, so that an iteration takes a single branch;
+    - labels that are no longer jumped to are dropped."""
+
+    ROTATE_LIMIT = 8
+
+    def __init__(self, ctx: ProcContext):
+        self.ctx     = ctx
+        self.cfg     = ctx.cfg
+        self.changes = 0
+
+    def _retarget(self, instr: TAC, label: str):
+        instr.arguments = instr.arguments[:-1] + [label]
+        self.changes += 1
+
+    def _final(self, label: str) -> str:
+        seen = set()
+        while label not in seen:
+            seen.add(label)
+            block = self.cfg.block(label)
+            if not block.instrs:
+                index = self.cfg.blocks.index(block)
+                if index+1 == len(self.cfg.blocks):
+                    break
+                label = self.cfg.label(self.cfg.blocks[index+1])
+            elif len(block.instrs) == 1 and block.instrs[0].opcode == 'jmp':
+                label = block.instrs[0].arguments[0]
+            else:
+                break
+        return label
+
+    def _thread(self):
+        for block in self.cfg.blocks:
+            term = block.terminator
+            if term is None or term.opcode in EXITS:
+                continue
+            target = self._final(term.arguments[-1])
+            if target != term.arguments[-1]:
+                self._retarget(term, target)
+            if term.opcode == 'jmp':
+                tblock = self.cfg.block(target)
+                if len(tblock.instrs) == 1 and tblock.instrs[0].opcode == 'ret':
+                    block.instrs[-1] = TAC('ret', tblock.instrs[0].arguments[:])
+                    self.changes += 1
+        self.cfg.relink()
+
+    def _layout(self):
+        blocks = self.cfg.blocks
+
+        for i, block in enumerate(blocks[:-1]):
+            term, nxt = block.terminator, blocks[i+1]
+
+            if term is None or term.opcode in EXITS:
+                continue
+
+            if term.arguments[-1] == nxt.label:
+                # jump to the next block
+                block.instrs.pop()
+                self.changes += 1
+
+            elif term.opcode in CJUMPS and i+2 < len(blocks)  \
+                    and nxt.preds == [block]                  \
+                    and len(nxt.instrs) == 1                  \
+                    and nxt.instrs[0].opcode == 'jmp'         \
+                    and term.arguments[-1] == blocks[i+2].label:
+                # invert the condition to fall through
+                term.opcode = INVERSE[term.opcode]
+                self._retarget(term, nxt.instrs[0].arguments[0])
+                nxt.instrs = []
+
+        self.cfg.relink()
+
+    def _rotate(self):
+        blocks = self.cfg.blocks
+
+        for i, block in enumerate(blocks):
+            term = block.terminator
+            if term is None or term.opcode != 'jmp':
+                continue
+            if term.arguments[0] not in self.headers:
+                continue
+            header = self.cfg.block(term.arguments[0])
+            hterm  = header.terminator
+            if header is block or not self.cfg.dominates(header, block):
+                continue
+            if hterm is None or hterm.opcode not in CJUMPS:
+                continue
+            if len(header.instrs) > self.ROTATE_LIMIT:
+                continue
+
+            hindex = blocks.index(header)
+            if hindex+1 == len(blocks):
+                continue
+
+            block.instrs[-1:] = [
+                TAC(x.opcode, x.arguments[:], x.result, x.link_depth)
+                for x in header.instrs
+            ]
+            blocks.insert(i+1, BasicBlock(None, [
+                TAC('jmp', [self.cfg.label(blocks[hindex+1])])
+            ]))
+            self.headers.discard(term.arguments[0])
+            self.changes += 1
+            self.cfg.relink()
+            return True
+
+        return False
+
+    def _prune(self):
+        used = set()
+        for block in self.cfg.blocks:
+            term = block.terminator
+            if term is not None and term.opcode not in EXITS:
+                used.add(term.arguments[-1])
+        for block in self.cfg.blocks:
+            if block.label not in used:
+                block.label = None
+
+    def run(self) -> int:
+        # each loop is rotated once: the copy of its condition may start
+        # a new back edge to the following block
+        self.headers = { self.cfg.label(x.header) for x in self.cfg.loops() }
+
+        while True:
+            count = self.changes
+            self._thread()
+            self._layout()
+            if self.changes == count and not self._rotate():
+                break
+        self._prune()
+        return self.changes
+
+# --------------------------------------------------------------------
+PIPELINES = {
+    0: [],
+    1: [Devirtualize, TailCalls, GVN, LICM, InductionVariables, GVN, DCE, BranchSimplify],
+}
+
+def optimize(
+    tac    : list[TACProc | TACVar],
+    level  : int = 1,
+    report : Opt[Callable[[str], None]] = None,
+) -> list[TACProc | TACVar]:
+    if level >= 1:
+        tac = LambdaLifter(tac, report = report).run()
+        tac = CallFolder(tac, report = report).run()
+        tac = Specializer(tac, report = report).run()
+        tac = Inliner(tac, report = report).run()
+        tac = Snapshot(tac, report = report).run()
+
+    nesting = Nesting(tac)
+    modref  = ModRef(nesting)
+
+    for proc in nesting.procs.values():
+        passes = PIPELINES[min(level, max(PIPELINES))]
+        if not passes:
+            continue
+        ctx = ProcContext(proc, nesting, modref)
+        for pass_ in passes:
+            pass_(ctx).run()
+        ctx.commit()
+
+    return tac
@@ -0,0 +1,268 @@
+# --------------------------------------------------------------------
+import dataclasses as dc
+import re
+
+# ====================================================================
+# Peephole optimisation of the x64 code
+#
+# The x64 back end emits structured instructions (`Instr` and `Label`)
+# that are only formatted at the very end. The rules below rewrite the
+# code of a procedure through a small window, until none applies:
+#
+#   self-move     movq X, X                     -> (removed)
+#   stack-adjust  addq/subq $0, %rsp            -> (removed)
+#   jump-next     jmp L / jcc L, followed by L: -> (removed)
+#   branch-over   jcc L1; jmp L2; L1:           -> jncc L2; L1:
+#   store-load    movq R, M; movq M, D          -> movq R, M; movq R, D
+#   dead-store    movq M, R; movq R, M          -> movq M, R
+#   move-fold     movq A, R; op R, B            -> op A, B     (R dead)
+#   retarget      op X, R; movq R, D            -> op X, D     (R dead)
+#   dead-move     movq X, R                     -> (removed)   (R dead)
+#   reload        movq M, R (R or S holds M)    -> (removed) / movq S, R
+#
+# A register is dead when it is written before being read, looking
+# forward in the straight-line code, and holds the value of a memory
+# operand when it was loaded from or stored to it, looking backward
+# (two memory operands with the same base register and different
+# offsets do not overlap). The scratch registers of the
+# back end (%r11, %r12, %r13) never carry a value across a label or
+# a jump.
+
+@dc.dataclass
+class Instr:
+    opcode : str
+    args   : list[str] = dc.field(default_factory = list)
+
+    def __str__(self):
+        if not self.args:
+            return f'\t{self.opcode}'
+        return f'\t{self.opcode}\t{", ".join(self.args)}'
+
+@dc.dataclass
+class Label:
+    name : str
+
+    def __str__(self):
+        return f'{self.name}:'
+
+# --------------------------------------------------------------------
+SCRATCH  = ('%r11', '%r12', '%r13')
+PARAMS   = ('%rdi', '%rsi', '%rdx', '%rcx', '%r8', '%r9')
+CALLEE   = ('%rbx', '%r14', '%r15')
+CLOBBERS = ('%rax', '%rcx', '%rdx', '%rsi', '%rdi', '%r8', '%r9', '%r10', '%r11')
+ALIASES  = { '%al': '%rax', '%cl': '%rcx' }
+
+MOVES    = ('movq', 'movabsq', 'movzbq', 'leaq')
+FOLDS    = ('addq', 'subq', 'andq', 'orq', 'xorq', 'cmpq')
+
+INVERSE  = {
+    'je' : 'jne', 'jne': 'je' , 'jz' : 'jnz', 'jnz': 'jz',
+    'jl' : 'jge', 'jge': 'jl' , 'jg' : 'jle', 'jle': 'jg',
+}
+
+JUMPS    = ('jmp',) + tuple(INVERSE)
+
+def is_reg(x: str) -> bool:
+    return x.startswith('%')
+
+def is_mem(x: str) -> bool:
+    return not is_reg(x) and not x.startswith('$')
+
+def regs_of(x: str) -> set[str]:
+    return { ALIASES.get(r, r) for r in re.findall(r'%\w+', x) }
+
+def disjoint(m1: str, m2: str) -> bool:
+    b1, b2 = m1.partition('('), m2.partition('(')
+    return b1[1:] == b2[1:] and b1[0] != b2[0]
+
+# --------------------------------------------------------------------
+def effects(instr: Instr) -> tuple[set[str], set[str]] | None:
+    # (registers read, registers written), None for the instructions
+    # whose effects are not modelled
+    args = instr.args
+    uses = set().union(*map(regs_of, args)) if args else set()
+
+    match instr.opcode, len(args):
+        case ('movq' | 'movabsq' | 'movzbq' | 'leaq'), 2:
+            if is_reg(args[1]) and instr.opcode != 'movzbq':
+                return regs_of(args[0]), regs_of(args[1])
+            return uses, regs_of(args[1]) if is_reg(args[1]) else set()
+        case ('cmpq' | 'testq'), 2:
+            return uses, set()
+        case ('addq' | 'subq' | 'andq' | 'orq' | 'xorq' | 'imulq' | 'salq' | 'sarq'), 2:
+            return uses, regs_of(args[1]) if is_reg(args[1]) else set()
+        case 'imulq', 3:
+            return regs_of(args[0]) | regs_of(args[1]), regs_of(args[2])
+        case ('negq' | 'notq' | 'incq' | 'decq'), 1:
+            return uses, uses if is_reg(args[0]) else set()
+        case 'imulq', 1:
+            return uses | {'%rax'}, {'%rax', '%rdx'}
+        case 'idivq', 1:
+            return uses | {'%rax', '%rdx'}, {'%rax', '%rdx'}
+        case 'cqto', 0:
+            return {'%rax'}, {'%rdx'}
+        case ('sete' | 'setne' | 'setl' | 'setle' | 'setg' | 'setge'), 1:
+            return uses, uses
+        case 'pushq', 1:
+            return uses | {'%rsp'}, {'%rsp'}
+        case 'popq', 1:
+            return {'%rsp'}, uses | {'%rsp'}
+        case 'callq', 1:
+            # %r10 holds the static link of nested callees, that may
+            # also access the variables kept in callee-saved registers
+            return uses | set(PARAMS) | set(CALLEE) | {'%r10', '%rsp'}, set(CLOBBERS)
+    return None
+
+def stored(instr: Instr) -> str | None:
+    # memory operand written by `instr`
+    match instr.opcode, instr.args:
+        case ('cmpq' | 'testq' | 'imulq'), _:
+            return None
+        case _, [_, dst] if is_mem(dst):
+            return dst
+        case ('negq' | 'notq' | 'incq' | 'decq'), [dst] if is_mem(dst):
+            return dst
+    return None
+
+# --------------------------------------------------------------------
+class Peephole:
+    WINDOW = 32
+
+    def __init__(self):
+        self.counts = dict()            # rule -> number of rewrites
+
+    def _dead(self, code: list, start: int, reg: str) -> bool:
+        # is `reg` dead before code[start]?
+        for item in code[start:]:
+            if isinstance(item, Label):
+                return reg in SCRATCH
+            rw = effects(item)
+            if rw is not None and reg in rw[0]:
+                return False
+            if item.opcode in JUMPS or item.opcode == 'retq':
+                return reg in SCRATCH and reg not in regs_of(' '.join(item.args))
+            if rw is None:
+                return False
+            if reg in rw[1]:
+                return True
+        return reg in SCRATCH
+
+    def _holder(self, code: list, end: int, mem: str) -> str | None:
+        # register that holds the value of `mem` before code[end]
+        written = set()
+        for item in code[max(0, end - self.WINDOW):end][::-1]:
+            if isinstance(item, Label) or item.opcode in JUMPS:
+                return None
+            rw = effects(item)
+            if rw is None or item.opcode == 'callq':
+                return None
+            if item.opcode == 'movq' and mem in item.args and item.args[0] != item.args[1]:
+                other = item.args[1] if item.args[0] == mem else item.args[0]
+                if is_reg(other) and other not in written and other not in regs_of(mem):
+                    return other
+            written |= rw[1]
+            if written & regs_of(mem):
+                return None
+            if stored(item) is not None and not disjoint(stored(item), mem):
+                return None
+        return None
+
+    def _labels(self, code: list, start: int) -> set[str]:
+        # labels that immediately follow code[start-1]
+        names = set()
+        for item in code[start:]:
+            if not isinstance(item, Label):
+                break
+            names.add(item.name)
+        return names
+
+    def _rewrite(self, code: list, i: int) -> str | None:
+        # applies a rule at code[i] (in place), returns its name
+        a = code[i]
+        b = code[i+1] if i+1 < len(code) else None
+
+        if isinstance(a, Label):
+            return None
+
+        op, args = a.opcode, a.args
+
+        if op == 'movq' and args[0] == args[1]:
+            del code[i]
+            return 'self-move'
+
+        if op in ('addq', 'subq') and args == ['$0', '%rsp']:
+            del code[i]
+            return 'stack-adjust'
+
+        if op == 'movq' and is_mem(args[0]) and is_reg(args[1]):
+            holder = self._holder(code, i, args[0])
+            if holder == args[1]:
+                del code[i]
+                return 'reload'
+            if holder is not None:
+                code[i] = Instr('movq', [holder, args[1]])
+                return 'reload'
+
+        if op in JUMPS and args[0] in self._labels(code, i+1):
+            del code[i]
+            return 'jump-next'
+
+        if op in INVERSE and isinstance(b, Instr) and b.opcode == 'jmp' \
+                and not b.args[0].startswith('*') and args[0] in self._labels(code, i+2):
+            code[i:i+2] = [Instr(INVERSE[op], [b.args[0]])]
+            return 'branch-over'
+
+        if op in MOVES + ('imulq',) and len(args) >= 2 and isinstance(b, Instr) \
+                and b.opcode == 'movq' and b.args[0] == args[-1] \
+                and is_reg(b.args[0]) and is_reg(b.args[1]):
+            rw = effects(a)
+            if rw is not None and rw[1] == {b.args[0]} and b.args[0] not in rw[0] \
+                    and self._dead(code, i+2, b.args[0]):
+                code[i:i+2] = [Instr(op, args[:-1] + [b.args[1]])]
+                return 'retarget'
+
+        if op != 'movq' or not isinstance(b, Instr):
+            if op in MOVES and is_reg(args[-1]) and args[-1] not in ('%rsp', '%rbp') \
+                    and self._dead(code, i+1, args[-1]):
+                del code[i]
+                return 'dead-move'
+            return None
+
+        src, dst = args
+
+        if b.opcode == 'movq' and is_mem(dst) and b.args[0] == dst and not is_mem(src):
+            if b.args[1] == src:
+                del code[i+1]
+            else:
+                code[i+1] = Instr('movq', [src, b.args[1]])
+            return 'store-load'
+
+        if b.opcode == 'movq' and is_mem(src) and is_reg(dst) and b.args == [dst, src] \
+                and dst not in regs_of(src):
+            del code[i+1]
+            return 'dead-store'
+
+        if is_reg(dst) and dst not in ('%rsp', '%rbp') and b.opcode in FOLDS + ('movq', 'pushq') \
+                and b.args[0] == dst and dst not in regs_of(' '.join(b.args[1:])) \
+                and not (is_mem(src) and any(is_mem(x) for x in b.args[1:])) \
+                and self._dead(code, i+2, dst):
+            code[i:i+2] = [Instr(b.opcode, [src] + b.args[1:])]
+            return 'move-fold'
+
+        if is_reg(dst) and dst not in ('%rsp', '%rbp') and self._dead(code, i+1, dst):
+            del code[i]
+            return 'dead-move'
+
+        return None
+
+    def run(self, code: list) -> list:
+        code = list(code)
+        i = 0
+        while i < len(code):
+            rule = self._rewrite(code, i)
+            if rule is None:
+                i += 1
+            else:
+                self.counts[rule] = self.counts.get(rule, 0) + 1
+                i = max(0, i-2)
+        return code
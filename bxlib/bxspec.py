@@ -0,0 +1,236 @@
+# --------------------------------------------------------------------
+from typing import Callable, Optional as Opt
+
+from .bxmm      import MM
+from .bxnesting import Nesting
+from .bxtac     import *
+
+# ====================================================================
+# Procedure specialisation
+#
+# The arguments of each direct call site are traced back, in the caller,
+# to the `fatptr` or the `const` that defines them. A procedure gets a
+# clone for each binding of its function-typed parameters to known
+# procedures found at its call sites; a parameter that is the same
+# constant at all the sites is bound as well, when the procedure does
+# not escape as a fat pointer (the original is then no longer called).
+# The bound parameters are no longer passed: the clone defines them on
+# entry, and calls through a bound function-typed parameter become
+# direct calls -- that the inliner may then inline.
+#
+# A procedure `g` bound to a parameter of `f` is called directly from
+# `f` with the static link that `f` computes for it, which is the one
+# of the record when the parent of `g` is an ancestor of `f` (both are
+# found on the static chain of the caller).
+
+JUMPS = ('jmp', 'jz', 'jnz', 'jeq', 'jne', 'jlt', 'jle', 'jgt', 'jge')
+
+class Specializer:
+    GROWTH    = 400             # instructions added by the clones
+    MAXCLONES = 4               # per procedure
+
+    def __init__(
+        self,
+        tac    : list[TACProc | TACVar],
+        report : Opt[Callable[[str], None]] = None,
+    ):
+        self.tac     = tac
+        self.report  = report or (lambda _: None)
+        self.nesting = Nesting(tac)
+        self.dropped = set()            # id(param) of the bound arguments
+        self.growth  = 0
+
+    @staticmethod
+    def _size(proc: TACProc) -> int:
+        return sum(1 for x in proc.tac if not isinstance(x, str))
+
+    def _sites(self) -> dict[str, list[tuple[str, TAC, dict[int, TAC]]]]:
+        # callee -> [(caller, call, position -> param)]
+        aout = dict()
+        for name, proc in self.nesting.procs.items():
+            params = dict()
+            for instr in proc.tac:
+                if isinstance(instr, str):
+                    continue
+                if instr.opcode == 'param':
+                    params[instr.arguments[0]] = instr
+                elif instr.opcode in ('call', 'callfatptr'):
+                    if instr.opcode == 'call' and instr.arguments[0] in self.nesting.procs:
+                        aout.setdefault(instr.arguments[0], []).append((name, instr, params))
+                    params = dict()
+        return aout
+
+    def _origin(self, name: str, temp: str | int) -> Opt[TAC]:
+        # the `fatptr` or `const` that defines a private temporary of
+        # `name`, possibly through a chain of copies
+        proc, seen = self.nesting.procs[name], set()
+        while is_temp(temp) and self.nesting.is_private(name, temp):
+            var = self.nesting.resolve(name, temp)
+            if var in seen or var[1] in proc.arguments:
+                return None
+            seen.add(var)
+            defs = [
+                x for x in proc.tac
+                if not isinstance(x, str) and x.result is not None
+                and self.nesting.resolve(name, x.result) == var
+            ]
+            if len(defs) != 1:
+                return None
+            match defs[0].opcode:
+                case 'fatptr' | 'const':
+                    return defs[0]
+                case 'copy':
+                    temp = defs[0].arguments[0]
+                case _:
+                    return None
+        return None
+
+    def _visible(self, proc: str, callee: str) -> bool:
+        # is the parent of `callee` an ancestor of `proc`?
+        parent = self.nesting.procs[callee].parent
+        name   = self.nesting.procs[proc].parent
+        while parent is not None and name is not None and name != parent:
+            name = self.nesting.procs[name].parent
+        return parent is None or name == parent
+
+    def _binding(self, proc: str, caller: str, param: TAC) -> Opt[tuple]:
+        value = param.arguments[1]
+        if isinstance(value, int):
+            return ('const', value)
+        origin = self._origin(caller, value)
+        match origin:
+            case TAC('fatptr', [callee]) if self._visible(proc, callee):
+                return ('fn', callee)
+            case TAC('const', [constant]):
+                return ('const', constant)
+        return None
+
+    def _redirect(self, call: TAC, params: dict[int, TAC], name: str, bound: dict[int, tuple]):
+        # the bound arguments are dropped, the others are renumbered
+        index = 0
+        for i in sorted(params):
+            if i in bound:
+                self.dropped.add(id(params[i]))
+            else:
+                index += 1
+                params[i].arguments[0] = index
+        call.arguments = [name, call.arguments[1] - len(bound)]
+
+    def _clone(self, proc: TACProc, name: str, bound: dict[int, tuple]) -> TACProc:
+        own    = proc.depth + 1
+        args   = { f'{proc.arguments[i-1]}:{own}': b for i, b in bound.items() }
+        labels = dict()
+
+        def label(x):
+            if x not in labels:
+                labels[x] = MM.fresh_label()
+            return labels[x]
+
+        body = []
+        for instr in proc.tac:
+            if isinstance(instr, str):
+                body.append(f'{label(instr[:-1])}:')
+                continue
+            if id(instr) in self.dropped:
+                continue
+            arguments = list(instr.arguments)
+            if instr.opcode in JUMPS:
+                arguments[-1] = label(arguments[-1])
+            if instr.opcode == 'callfatptr' and args.get(arguments[0], (None,))[0] == 'fn':
+                callee = args[arguments[0]][1]
+                body.append(TAC(
+                    'call', [callee, arguments[1]], instr.result,
+                    self.nesting.link_depth(proc.name, callee),
+                ))
+                continue
+            body.append(TAC(instr.opcode, arguments, instr.result, instr.link_depth))
+
+        # the bound parameters that are still read
+        used   = { x for instr in body if not isinstance(instr, str) for x in instr.arguments }
+        prefix = []
+        for arg, (kind, value) in args.items():
+            if arg not in used:
+                continue
+            if kind == 'const':
+                prefix.append(TAC('const', [value], arg))
+            else:
+                link = self.nesting.link_depth(proc.name, value)
+                prefix.append(TAC('fatptr', [value], arg, 0 if link is None else link))
+
+        clone = TACProc(
+            proc.depth, name,
+            [x for i, x in enumerate(proc.arguments) if i+1 not in bound],
+            proc.parent,
+        )
+        clone.tac = prefix + body
+        return clone
+
+    def _specialise(self, proc: TACProc, sites: list, addressed: bool) -> list[TACProc]:
+        nargs    = len(proc.arguments)
+        bindings = [
+            tuple(
+                self._binding(proc.name, caller, params[i]) if i in params else None
+                for i in range(1, nargs + 1)
+            )
+            for caller, _, params in sites
+        ]
+
+        for i in range(nargs):
+            if addressed or len({ b[i] for b in bindings }) > 1:
+                bindings = [
+                    b[:i] + ((b[i] if b[i] and b[i][0] == 'fn' else None),) + b[i+1:]
+                    for b in bindings
+                ]
+
+        groups = dict()
+        for site, binding in zip(sites, bindings):
+            if any(binding):
+                groups.setdefault(binding, []).append(site)
+
+        clones = []
+        for binding, group in sorted(groups.items(), key = lambda x: -len(x[1]))[:self.MAXCLONES]:
+            # a clone that replaces the original does not grow the code
+            size = 0 if len(group) == len(sites) and not addressed else self._size(proc)
+            if self.growth + size > self.GROWTH:
+                break
+            self.growth += size
+
+            bound = { i+1: b for i, b in enumerate(binding) if b is not None }
+            name  = MM.fresh_proc_label(proc.name)
+
+            # the recursive call sites are redirected in the clone too
+            for _, call, params in group:
+                self._redirect(call, params, name, bound)
+            clones.append(self._clone(proc, name, bound))
+
+            self.report(
+                f'specialise: {name} cloned from {proc.name} for '
+                + ', '.join(f'{proc.arguments[i-1]} = {v}' for i, (_, v) in sorted(bound.items()))
+                + f' ({len(group)} call sites)'
+            )
+
+        return clones
+
+    def run(self) -> list[TACProc | TACVar]:
+        sites     = self._sites()
+        addressed = {
+            x.arguments[0] for p in self.nesting.procs.values()
+            for x in p.tac if not isinstance(x, str) and x.opcode == 'fatptr'
+        }
+
+        clones = dict()
+        for name, proc in list(self.nesting.procs.items()):
+            if name == 'main' or self.nesting.children[name] or name not in sites:
+                continue
+            clones[name] = self._specialise(proc, sites[name], name in addressed)
+
+        for proc in self.nesting.procs.values():
+            proc.tac = [x for x in proc.tac if id(x) not in self.dropped]
+
+        # the clones are emitted next to their original
+        aout = []
+        for decl in self.tac:
+            aout.append(decl)
+            if isinstance(decl, TACProc):
+                aout.extend(clones.get(decl.name, []))
+        return aout
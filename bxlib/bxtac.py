@@ -21,6 +21,14 @@ OPCODES = {
     'logical-right-shift' : 'shr',
 }
 
+# instructions whose operands may be immediates (signed 32-bit
+# integers) instead of temporaries
+IMMEDIATES = (
+    'add', 'sub', 'mul', 'div', 'mod', 'and', 'or', 'xor', 'shl', 'shr',
+    'jeq', 'jne', 'jlt', 'jle', 'jgt', 'jge',
+    'seteq', 'setne', 'setlt', 'setle', 'setgt', 'setge',
+)
+
 # --------------------------------------------------------------------
 @dc.dataclass
 class TAC:
@@ -51,10 +59,17 @@ class TAC:
 class TACProc:
     __match_args__ = ('depth', 'name', 'arguments', 'tac')
 
-    def __init__(self, depth: int, name: str, arguments: list[str]):
+    def __init__(
+        self,
+        depth     : int,
+        name      : str,
+        arguments : list[str],
+        parent    : Opt[str] = None,
+    ):
         self.depth      = depth
         self.name       = name
         self.arguments  = arguments
+        self.parent     = parent
         self.tac        = []
 
     def __repr__(self):
@@ -76,3 +91,26 @@ class TACVar:
 
     def __repr__(self):
         return f"var @{self.name} = {self.value};"
+
+# --------------------------------------------------------------------
+def is_temp(x: str | int) -> bool:
+    return isinstance(x, str) and x[:1] in ('%', '@')
+
+# --------------------------------------------------------------------
+def split_temp(temp: str) -> tuple[str, Opt[int]]:
+    # "%x:2" -> ("%x", 2), "%x" -> ("%x", None)
+    parts = temp.split(':')
+    if len(parts) == 2:
+        return parts[0], int(parts[1])
+    return temp, None
+
+# --------------------------------------------------------------------
+def temps_of(instr: TAC) -> list[str]:
+    aout = [x for x in instr.arguments if is_temp(x)]
+    if instr.result is not None:
+        aout.append(instr.result)
+    return aout
+
+# --------------------------------------------------------------------
+def fits32(value: int) -> bool:
+    return -2**31 <= value < 2**31
@@ -356,7 +356,7 @@ class TypeChecker:
 
                 if not self.check_constant(init):
                     self.report(
-                        'this expression is not a literal',
+                        'this expression is not constant',
                         position = init.position,
                     )
 
@@ -365,10 +365,15 @@ class TypeChecker:
             self.for_topdecl(decl)
 
     def check_constant(self, expr: Expression):
+        # literals, operators and calls: the value is computed at
+        # compile time (see `MM.for_program`)
         match expr:
-            case IntExpression(_):
+            case IntExpression(_) | BoolExpression(_):
                 return True
 
+            case OpAppExpression(_, arguments) | CallExpression(_, arguments):
+                return all(self.check_constant(x) for x in arguments)
+
             case _:
                 return False
 
@@ -75,7 +75,10 @@ def _main():
 
     print("completed typechecking with no errors")
 
-    tac = MM.mm(prgm)
+    tac = MM.mm(prgm, reporter = reporter)
+
+    if tac is None:
+        exit(1)
 
     for t in tac:
         print(t)